@@ -0,0 +1,47 @@
+"""Wall clock of independent queries run one by one vs db.gather, with simulated network latency.
+
+    python benchmarks/bench_gather.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dbtool  # noqa: E402
+
+LATENCY = 0.005
+QUERIES = 16
+
+
+class LatencyListener(dbtool.Listener):
+    """simulate the network round trip of every statement."""
+
+    def before_execute(self, statement, args):
+        time.sleep(LATENCY)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        url = 'sqlite:///' + os.path.join(directory, 'bench.db')
+        for maxconnections in (4, 8, 16):
+            db = dbtool.connect(url, maxconnections=maxconnections, blocking=True, check_same_thread=False)
+            db.execute('create table if not exists user (id integer primary key, name text)')
+            db.add_listener(LatencyListener())
+            calls = [('select * from user where id = ?', (i,)) for i in range(QUERIES)]
+
+            start = time.perf_counter()
+            for sql, args in calls:
+                db.execute(sql, args)
+            sequential = time.perf_counter() - start
+
+            start = time.perf_counter()
+            db.gather(calls)
+            gathered = time.perf_counter() - start
+            print('maxconnections=%-3d sequential %7.1f ms  gather %7.1f ms  speedup %.1fx'
+                  % (maxconnections, sequential * 1000, gathered * 1000, sequential / gathered))
+
+
+if __name__ == '__main__':
+    main()
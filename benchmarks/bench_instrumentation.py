@@ -0,0 +1,92 @@
+"""Overhead of DB instrumentation: no listener, a no-op listener and the built-in StatsListener.
+
+The no listener path is measured against baselines without hooks: raw sqlite3, and the commit added the hooks
+against its parent, both read from git, so the hooks alone cost the difference of the two.
+
+    python benchmarks/bench_instrumentation.py
+"""
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import dbtool  # noqa: E402
+
+NUMBER = 20000
+SQL = 'select * from user where id = ?'
+
+
+def setup_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute('create table user (id integer primary key, name text, age integer)')
+    conn.executemany('insert into user(name, age) values(?, ?)', [('name%d' % i, i % 100) for i in range(1000)])
+    conn.commit()
+    return conn
+
+
+def bench(func):
+    return min(timeit.repeat(func, number=NUMBER, repeat=5)) / NUMBER
+
+
+def bench_revision(revision, url):
+    """returns seconds per find_one of dbtool of the git revision without listener, measured in a child process as
+    dbtool patches sqlite3 on import, None if the revision is unavailable."""
+    source = subprocess.run(['git', 'show', revision + ':dbtool.py'], capture_output=True, text=True, cwd=ROOT)
+    if source.returncode != 0:
+        return None
+    code = ('import sys, timeit, types; module = types.ModuleType("dbtool"); sys.modules["dbtool"] = module; '
+            'exec(compile(sys.stdin.read(), "dbtool.py", "exec"), module.__dict__); '
+            'db = module.connect(sys.argv[1], mincached=1); '
+            'func = lambda: db.find_one("user", {"id": 500}); '
+            'print(min(timeit.repeat(func, number=%d, repeat=5)) / %d)' % (NUMBER, NUMBER))
+    result = subprocess.run([sys.executable, '-c', code, url], input=source.stdout, capture_output=True, text=True)
+    return float(result.stdout) if result.returncode == 0 else None
+
+
+def hooks_revision():
+    """returns the commit added the listener hooks, None out of git checkout."""
+    result = subprocess.run(['git', 'log', '-S', 'def add_listener', '--reverse', '--format=%h', '--', 'dbtool.py'],
+                            capture_output=True, text=True, cwd=ROOT)
+    commits = result.stdout.split() if result.returncode == 0 else []
+    return commits[0] if commits else None
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        conn = setup_db(path)
+        url = 'sqlite:///' + path
+        raw = bench(lambda: conn.execute(SQL, (500,)).fetchone())
+        print('%-28s %8.2f us/call' % ('sqlite3 execute + fetchone', raw * 1e6))
+
+        # the hooks alone: dbtool of the commit added them against its parent, both without listener
+        revision = hooks_revision()
+        base = bench_revision(revision + '^', url) if revision else None
+        hooked = bench_revision(revision, url) if revision else None
+        if base is None or hooked is None:
+            print('dbtool before hooks: unavailable out of git checkout')
+        else:
+            print('%-28s %8.2f us/call' % ('before hooks ' + revision + '^', base * 1e6))
+            print('%-28s %8.2f us/call  %+6.1f%%  %+6.2f us' % ('hooks ' + revision + ', no listener', hooked * 1e6,
+                                                                (hooked / base - 1) * 100, (hooked - base) * 1e6))
+
+        db = dbtool.connect(url, mincached=1)
+        baseline = bench(lambda: db.find_one('user', {'id': 500}))
+        print('%-28s %8.2f us/call  overhead %6.2f us over sqlite3' % ('no listener', baseline * 1e6,
+                                                                        (baseline - raw) * 1e6))
+        listener = db.add_listener(dbtool.Listener())
+        noop = bench(lambda: db.find_one('user', {'id': 500}))
+        print('%-28s %8.2f us/call  %+6.1f%%' % ('no-op listener', noop * 1e6, (noop / baseline - 1) * 100))
+        db.remove_listener(listener)
+        db.enable_stats()
+        stats = bench(lambda: db.find_one('user', {'id': 500}))
+        print('%-28s %8.2f us/call  %+6.1f%%' % ('StatsListener', stats * 1e6, (stats / baseline - 1) * 100))
+
+
+if __name__ == '__main__':
+    main()
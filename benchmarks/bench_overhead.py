@@ -0,0 +1,47 @@
+"""Per call overhead of primary key lookups on sqlite: raw sqlite3 vs db.execute_fetchone and db.find_one,
+with the default pool, reused cursors and thread local connections.
+
+    python benchmarks/bench_overhead.py
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dbtool  # noqa: E402
+
+CALLS = 20000
+SQL = 'select * from user where id = ?'
+
+
+def report(name, func, baseline=None):
+    seconds = min(timeit.repeat(func, number=CALLS, repeat=5)) / CALLS
+    extra = '' if baseline is None else '  overhead %6.2f us' % ((seconds - baseline) * 1e6)
+    print('%-46s %6.2f us/call%s' % (name, seconds * 1e6, extra))
+    return seconds
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        conn = sqlite3.connect(path)
+        conn.execute('create table user (id integer primary key, name text, age integer)')
+        conn.executemany('insert into user(name, age) values(?, ?)', [('u%d' % i, i) for i in range(100)])
+        conn.commit()
+        baseline = report('sqlite3 execute + fetchone', lambda: conn.execute(SQL, (7,)).fetchone())
+        engines = [
+            ('pooled', {}),
+            ('pooled, reuse_cursors', {'reuse_cursors': True}),
+            ('thread_local, reuse_cursors', {'thread_local': True, 'reuse_cursors': True}),
+        ]
+        for name, options in engines:
+            db = dbtool.connect('sqlite:///' + path, **options)
+            report(name + ' execute_fetchone', lambda: db.execute_fetchone(SQL, (7,), row_type=tuple), baseline)
+            report(name + ' find_one', lambda: db.find_one('user', {'id': 7}), baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Point selects and single row inserts per second on a sqlite file database: raw sqlite3, the pooled DB,
+the thread local DB and the thread local DB with SQLITE_FAST_PRAGMAS.
+
+    python benchmarks/bench_sqlite.py
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dbtool  # noqa: E402
+
+SELECTS = 20000
+INSERTS = 1000
+
+
+def bench(name, select, insert):
+    start = time.perf_counter()
+    for i in range(SELECTS):
+        select(i % 100 + 1)
+    selects = SELECTS / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for i in range(INSERTS):
+        insert(i)
+    inserts = INSERTS / (time.perf_counter() - start)
+    print('%-24s select %9.0f /s  insert %9.0f /s' % (name, selects, inserts))
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        conn = sqlite3.connect(path)
+        conn.execute('create table user (id integer primary key, name text, age integer)')
+        conn.executemany('insert into user(name, age) values(?, ?)', [('u%d' % i, i) for i in range(100)])
+        conn.commit()
+
+        def raw_insert(i):
+            conn.execute('insert into user(name, age) values(?, ?)', ('n', i))
+            conn.commit()
+
+        bench('sqlite3', lambda i: conn.execute('select * from user where id = ?', (i,)).fetchone(), raw_insert)
+        conn.close()
+        engines = [
+            ('pooled', {}),
+            ('thread_local', {'thread_local': True}),
+            ('thread_local + pragmas', {'thread_local': True, 'pragmas': dbtool.SQLITE_FAST_PRAGMAS}),
+        ]
+        for name, options in engines:
+            db = dbtool.connect('sqlite:///' + path, **options)
+            bench(name, lambda i: db.find_one('user', {'id': i}), lambda i: db.insert({'name': 'n', 'age': i}, 'user'))
+
+
+if __name__ == '__main__':
+    main()
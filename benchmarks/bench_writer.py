@@ -0,0 +1,39 @@
+"""Rows per second of db.insert one by one vs the write-behind db.writer, on a sqlite file database.
+
+    python benchmarks/bench_writer.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dbtool  # noqa: E402
+
+ROWS = 2000
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        url = 'sqlite:///' + os.path.join(directory, 'bench.db')
+        db = dbtool.connect(url)
+        db.execute('create table event (id integer primary key, name text, value integer)')
+        events = [{'name': 'event%d' % i, 'value': i} for i in range(ROWS)]
+
+        start = time.perf_counter()
+        for event in events:
+            db.insert(event, table='event')
+        inserted = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with db.writer(table='event', batch_size=1000, flush_interval=0.1) as writer:
+            for event in events:
+                writer.insert(event)
+        written = time.perf_counter() - start
+        print('insert %9.0f rows/s  writer %9.0f rows/s  speedup %.1fx'
+              % (ROWS / inserted, ROWS / written, inserted / written))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""Benchmark suite of dbtool hot paths on sqlite, every case is reported alongside raw sqlite3 doing the same work.
+
+    python benchmarks/run.py                       # print results
+    python benchmarks/run.py --json result.json    # also write machine readable results
+    python benchmarks/run.py --compare base.json   # compare with previous results, exit 1 on regression
+    python benchmarks/run.py --quick -k find       # fewer iterations, only cases contain 'find'
+
+Per call cases are in us/call (lower is better), throughput cases are in ops/s (higher is better).
+Both sides use the same database file with synchronous=off, so numbers measure python overhead, not fsync.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dbtool  # noqa: E402
+
+ROWS = 1000
+PRAGMAS = {'synchronous': 'off', 'journal_mode': 'wal'}
+
+
+class User:
+    TABLE_NAME = 'user'
+
+    def __init__(self, id=None, name=None, age=None):
+        self.id = id
+        self.name = name
+        self.age = age
+
+
+class Suite:
+
+    def __init__(self, path, number, repeat):
+        self.path = path
+        self.number = number
+        self.repeat = repeat
+        self.results = {}
+        raw = sqlite3.connect(path)
+        raw.execute('create table user (id integer primary key, name text, age integer)')
+        raw.executemany('insert into user(name, age) values(?, ?)', [('name%d' % i, i % 100) for i in range(ROWS)])
+        raw.commit()
+        raw.close()
+        self.raw = self.raw_connect()
+        self.db = dbtool.connect('sqlite:///' + path, pragmas=PRAGMAS, check_same_thread=False)
+
+    def raw_connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        for name, value in PRAGMAS.items():
+            conn.execute(f'PRAGMA {name}={value}').fetchall()
+        return conn
+
+    def per_call(self, name, func, raw_func, number=None, calls=1):
+        """time func and raw_func, calls is the number of operations of one func call."""
+        number = number or self.number
+        value = min(timeit.repeat(func, number=number, repeat=self.repeat)) / number / calls * 1e6
+        raw = min(timeit.repeat(raw_func, number=number, repeat=self.repeat)) / number / calls * 1e6
+        self.add(name, value, raw, 'us/call')
+
+    def add(self, name, value, raw, unit):
+        ratio = value / raw if raw else None
+        self.results[name] = {'value': value, 'raw': raw, 'ratio': ratio, 'unit': unit}
+        print('%-34s %12.2f %-8s raw %12.2f  x%.2f' % (name, value, unit, raw, ratio or 0))
+
+
+def bench_sql(suite):
+    db, raw = suite.db, suite.raw
+    sql = 'select * from user where id = ?'
+    suite.per_call('execute', lambda: db.execute(sql, (500,)), lambda: raw.execute(sql, (500,)).fetchall())
+    suite.per_call('execute_fetchone', lambda: db.execute_fetchone(sql, (500,)),
+                   lambda: raw.execute(sql, (500,)).fetchone())
+    suite.per_call('execute row_type=tuple', lambda: db.execute(sql, (500,), row_type=tuple),
+                   lambda: raw.execute(sql, (500,)).fetchall())
+    rows = [('batch%d' % i, i) for i in range(100)]
+    insert_sql = 'insert into batch(name, age) values(?, ?)'
+    raw.execute('create table batch (id integer primary key, name text, age integer)')
+
+    def raw_batch():
+        raw.executemany(insert_sql, rows)
+        raw.commit()
+
+    suite.per_call('execute_batch 100 rows, per row', lambda: db.execute_batch(insert_sql, rows), raw_batch,
+                   number=max(1, suite.number // 100), calls=len(rows))
+
+
+def bench_crud(suite):
+    db, raw = suite.db, suite.raw
+
+    def raw_write(sql, args):
+        raw.execute(sql, args)
+        raw.commit()
+
+    suite.per_call('insert', lambda: db.insert({'name': 'n', 'age': 1}, table='user'),
+                   lambda: raw_write('INSERT INTO user(name, age) VALUES(?, ?)', ('n', 1)))
+    suite.per_call('update', lambda: db.update({'id': 500, 'name': 'n', 'age': 1}, table='user'),
+                   lambda: raw_write('UPDATE user SET name=?, age=? WHERE id = ?', ('n', 1, 500)))
+    suite.per_call('delete', lambda: db.delete('user', {'id': -1}),
+                   lambda: raw_write('DELETE FROM user WHERE id=?', (-1,)))
+    suite.per_call('find_one', lambda: db.find_one('user', {'id': 500}),
+                   lambda: raw.execute('SELECT * FROM user WHERE id=? LIMIT 1', (500,)).fetchone())
+    suite.per_call('find', lambda: db.find('user', {'id': 500}),
+                   lambda: raw.execute('SELECT * FROM user WHERE id=?', (500,)).fetchall())
+    suite.per_call('find_count', lambda: db.find_count({'age': 5}, table='user'),
+                   lambda: raw.execute('SELECT count(*) total FROM user WHERE age=?', (5,)).fetchone()[0])
+    users = [{'name': 'many%d' % i, 'age': i} for i in range(ROWS)]
+
+    def raw_many():
+        raw.executemany('INSERT INTO user(name, age) VALUES(?, ?)', [(u['name'], u['age']) for u in users])
+        raw.commit()
+
+    suite.per_call('insert_many 1000 rows, per row', lambda: db.insert_many(users, table='user'), raw_many,
+                   number=max(1, suite.number // 1000), calls=len(users))
+
+
+def bench_hydration(suite):
+    db, raw = suite.db, suite.raw
+    sql = 'SELECT * FROM user WHERE id <= ?'
+
+    def raw_entities():
+        return [User(*row) for row in raw.execute(sql, (ROWS,))]
+
+    number = max(1, suite.number // 1000)
+    suite.per_call('find 1000 entities, per row', lambda: db.find(User, {'id__lte': ROWS}), raw_entities,
+                   number=number, calls=ROWS)
+    suite.per_call('find 1000 dbtool.Row, per row',
+                   lambda: db.find('user', {'id__lte': ROWS}, return_type=dbtool.Row),
+                   lambda: raw.execute(sql, (ROWS,)).fetchall(), number=number, calls=ROWS)
+
+
+def bench_transaction(suite):
+    db, raw = suite.db, suite.raw
+    sql = 'UPDATE user SET age=? WHERE id=?'
+
+    def transaction():
+        with db.transaction():
+            for i in range(10):
+                db.execute(sql, (i, i + 1))
+
+    def raw_transaction():
+        for i in range(10):
+            raw.execute(sql, (i, i + 1))
+        raw.commit()
+
+    number = max(1, suite.number // 10)
+    value = number / min(timeit.repeat(transaction, number=number, repeat=suite.repeat))
+    raw_value = number / min(timeit.repeat(raw_transaction, number=number, repeat=suite.repeat))
+    suite.add('transaction of 10 updates', value, raw_value, 'ops/s')
+
+
+def bench_threads(suite):
+    sql = 'select * from user where id = ?'
+    for threads in (1, 4, 8):
+        db = dbtool.connect('sqlite:///' + suite.path, maxconnections=threads, blocking=True,
+                            pragmas=PRAGMAS, check_same_thread=False)
+        value = throughput(threads, suite.number, lambda: lambda i: db.execute_fetchone(sql, (i % ROWS + 1,)))
+
+        def raw_worker():
+            conn = suite.raw_connect()
+            return lambda i: conn.execute(sql, (i % ROWS + 1,)).fetchone()
+
+        raw_value = throughput(threads, suite.number, raw_worker)
+        suite.add('threads=%d maxconnections=%d' % (threads, threads), value, raw_value, 'ops/s')
+
+
+def throughput(threads, number, make_worker):
+    """returns operations per second of threads, each runs number operations of its worker."""
+    workers = [make_worker() for _ in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+
+    def run(worker):
+        barrier.wait()
+        for i in range(number):
+            worker(i)
+
+    pool = [threading.Thread(target=run, args=(worker,)) for worker in workers]
+    for thread in pool:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in pool:
+        thread.join()
+    return threads * number / (time.perf_counter() - start)
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+    }
+
+
+def compare(results, path, threshold):
+    """print changes against previous results, returns names of regressions beyond threshold."""
+    with open(path) as f:
+        previous = json.load(f)['results']
+    regressions = []
+    print('\n%-34s %12s %12s %8s' % ('compare with ' + os.path.basename(path), 'before', 'after', 'change'))
+    for name, result in results.items():
+        if name not in previous:
+            continue
+        before, after = previous[name]['value'], result['value']
+        change = (after - before) / before if before else 0.0
+        worse = change > threshold if result['unit'] == 'us/call' else change < -threshold
+        if worse:
+            regressions.append(name)
+        print('%-34s %12.2f %12.2f %+7.1f%%%s' % (name, before, after, change * 100, '  REGRESSION' if worse else ''))
+    return regressions
+
+
+CASES = [bench_sql, bench_crud, bench_hydration, bench_transaction, bench_threads]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='dbtool benchmark suite on sqlite')
+    parser.add_argument('--json', help='write results to the json file')
+    parser.add_argument('--compare', help='compare with results of the json file')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative change reported as regression')
+    parser.add_argument('--quick', action='store_true', help='fewer iterations, for smoke runs')
+    parser.add_argument('-k', dest='keyword', help='run case groups whose function name contains keyword')
+    args = parser.parse_args(argv)
+    number, repeat = (1000, 2) if args.quick else (10000, 5)
+    with tempfile.TemporaryDirectory() as directory:
+        suite = Suite(os.path.join(directory, 'bench.db'), number, repeat)
+        for case in CASES:
+            if not args.keyword or args.keyword in case.__name__:
+                case(suite)
+        suite.raw.close()
+    output = {'meta': metadata(), 'results': suite.results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        return 1 if compare(suite.results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,37 +1,130 @@
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import csv
 import functools
+import heapq
 import importlib
+import io
+import itertools
+import json
+import logging
+import os
+import queue
+import random
 import re
 import threading
+import time
+import weakref
+import zlib
 from urllib.parse import urlparse
 
-from dbutils.pooled_db import PooledDB
+from dbutils.persistent_db import PersistentDB
+from dbutils.pooled_db import PooledDB, PooledDedicatedDBConnection
+
+_logger = logging.getLogger('dbtool')
 
 
 class DB:
 
     def __init__(self, url, row_factory=None, handle_placeholder=True, mincached=0, maxconnections=0, blocking=False,
-                 **options):
+                 statement_cache_size=256, placeholder_cache_size=256, row_type=None, replicas=None,
+                 balance='round_robin', thread_local=False, reuse_cursors=False, prepared_statements=False,
+                 max_lifetime=None, idle_timeout=None, reap_interval=None, ping=1, **options):
         """ Init DB.
         :param handle_placeholder: handle sql placeholder
-        :param mincached: initial number of idle connections in the pool
+        :param mincached: initial number of idle connections in the pool, refilled at checkout after reaping
             (0 means no connections are made at startup)
         :param maxconnections: maximum number of connections generally allowed
             (0 or None means an arbitrary number of connections)
         :param blocking: determines behavior when exceeding the maximum
             (if this is set to true, block and wait until the number of
             connections decreases, otherwise an error will be reported)
+        :param statement_cache_size: maximum number of compiled crud statements
+            (0 disables the cache, None means unbounded)
+        :param placeholder_cache_size: maximum number of sql statements kept with their rewritten placeholder
+            and type (0 disables the cache, None means unbounded)
+        :param row_type: default type of returned rows: dict, tuple, dbtool.Row or sqlite3.Row
+            (None means rows created by row_factory, dict by default)
+        :param replicas: urls of read replicas, each has its own pool, select statements out of
+            transaction are routed to replicas, see use_primary
+        :param balance: replicas balance strategy: round_robin or least_outstanding
+        :param thread_local: each thread keeps its own persistent connection instead of the shared pool, it
+            suits sqlite and thread pools of fixed size, the pool parameters are ignored
+        :param reuse_cursors: each pooled connection keeps its cursors for execute calls instead of opening one
+            every call, cursors returned by execute_cursor and streaming iterators are not reused
+        :param prepared_statements: postgresql only, statements of this DB are prepared once per connection by
+            PREPARE and run by EXECUTE, the least recently used ones beyond statement_cache_size statements per
+            connection are deallocated, statements other than SELECT, INSERT, UPDATE and DELETE run directly
+        :param max_lifetime: seconds a connection lives, older ones are closed at checkin or by reaping, thread
+            local ones are reopened at the next use (None means unlimited)
+        :param idle_timeout: seconds a connection may be idle in the pool before it is closed (None means unlimited)
+        :param reap_interval: seconds between background reaping of idle connections
+            (None means half of the smaller of max_lifetime and idle_timeout, no reaping if both are None)
+        :param ping: when the connection is checked alive, see dbutils: 0 never, 1 checkout from the pool, 2 cursor
+            created, 4 query executed, 7 always, the check is the ping() of driver connection, or a sql statement or
+            callable as (1, 'SELECT 1')
         :param options: dbms driver connect parameter, see sqlite3, pymysql, ...
+            sqlite: pragmas: dict of {pragma: value} run on every new connection, e.g. SQLITE_FAST_PRAGMAS,
+            the :memory: database is one shared cache database of all connections of the DB
         """
         database_url = _DatabaseUrl(url)
+        self._dict_rows = row_factory is None
+        pool_options = dict(mincached=mincached, maxconnections=maxconnections, blocking=blocking, ping=ping,
+                            max_lifetime=max_lifetime, idle_timeout=idle_timeout, reap_interval=reap_interval)
+        pool_class = _Pool
+        if thread_local:
+            pool_class = _PersistentPool
+            pool_options = dict(ping=ping, max_lifetime=max_lifetime, idle_timeout=idle_timeout)
+        replica_options = (row_factory, handle_placeholder, options)
         creator, placeholder, row_factory, handle_placeholder, kwargs = self._resolve_dbms(database_url, row_factory,
                                                                                            handle_placeholder, options)
-        self._datasource = PooledDB(creator, mincached=mincached, maxconnections=maxconnections, blocking=blocking,
-                                    **kwargs)
+        self._datasource = pool_class(creator, **pool_options, **kwargs)
+        self._replicas = []
+        for replica_url in replicas or ():
+            replica_url = _DatabaseUrl(replica_url)
+            if replica_url.dbms != database_url.dbms:
+                raise Exception('replica dbms must be:' + database_url.dbms)
+            replica_creator, *_, replica_kwargs = self._resolve_dbms(replica_url, *replica_options)
+            self._replicas.append(pool_class(replica_creator, **pool_options, **replica_kwargs))
+        if balance not in ('round_robin', 'least_outstanding'):
+            raise Exception('unsupported balance:' + balance)
+        self._balance = balance
+        self._outstanding = [0] * len(self._replicas)
+        self._round_robin = itertools.count()
+        self._replica_lock = threading.Lock()
+        self._use_primary = contextvars.ContextVar('dbtool_use_primary_%x' % id(self), default=False)
+        self._maxconnections = maxconnections
+        self._mincached = mincached
+        self._executor = None
+        self._executor_lock = threading.Lock()
         self._dbms = database_url.dbms
+        if prepared_statements and self._dbms != 'postgresql':
+            raise Exception('prepared statements are unsupported by dbms:' + self._dbms)
+        self._reuse_cursors = reuse_cursors
+        self._prepared = weakref.WeakKeyDictionary() if prepared_statements else None
+        self._prepared_limit = statement_cache_size
         self._handle_placeholder = handle_placeholder
         self._placeholder = placeholder
         self._row_factory = row_factory
-        self.__transaction_ctx = _TransactionCtx()
+        self._row_type = row_type
+        self.statement_cache = _LRUCache(statement_cache_size)
+        self.placeholder_cache = _LRUCache(placeholder_cache_size)
+        self._placeholder_pattern = _placeholder_pattern(self._dbms)
+        self._cursor_options = {}
+        self._listeners = ()
+        self._stats = None
+        self._profiler = None
+        self.result_cache = None
+        self.count_cache = None
+        self._auto_increment_step = None
+        self._count_strategies = {}
+        self._retries = {'retries': 0, 'recovered': 0, 'exhausted': 0}
+        self._retry_lock = threading.Lock()
+        self._transaction_ctx = _TransactionCtx(self)
 
     @staticmethod
     def _resolve_dbms(database_url, row_factory, handle_placeholder, options):
@@ -44,13 +137,16 @@ class DB:
         connect_parameters['database'] = database_url.database
         if dbms == 'sqlite':
             import sqlite3
-            creator = sqlite3
             placeholder = '?'
             handle_placeholder = False
             row_factory = row_factory or DB.__dict_factory
-            creator.connect = functools.partial(DB.__sqlite3_connect, connect=creator.connect, row_factory=row_factory)
             for key in ['host', 'port', 'user', 'password']:
                 del connect_parameters[key]
+            connect_parameters.setdefault('cached_statements', 256)
+            # a pooled connection is used by one thread at a time, but not always the thread opened it
+            connect_parameters.setdefault('check_same_thread', False)
+            pragmas = connect_parameters.pop('pragmas', None)
+            creator = _SqliteConnector(sqlite3, row_factory, pragmas, connect_parameters['database'] == ':memory:')
         elif dbms == 'mysql':
             import pymysql
             creator = pymysql
@@ -71,75 +167,410 @@ class DB:
             raise Exception('unsupported dbms:' + dbms)
         return creator, placeholder, row_factory, handle_placeholder, connect_parameters
 
-    def __connection(self):
-        """open a connection."""
-        if self.__transaction_ctx.conn:
-            return self.__transaction_ctx.conn
-        conn = self._datasource.connection()
-        if self._row_factory:
-            if self._dbms == 'mysql':
-                conn.cursor = functools.partial(conn.cursor, self._row_factory)
-            elif self._dbms == 'postgresql':
-                conn.cursor = functools.partial(conn.cursor, cursor_factory=self._row_factory)
-            elif self._dbms == 'sqlserver':
-                conn.cursor = functools.partial(conn.cursor, as_dict=True)
-        self.__transaction_ctx.init_conn_maybe(conn)
+    def __connection(self, read=False):
+        """open a connection, read connection is from replicas if not in transaction."""
+        state = self._transaction_ctx.state
+        if state is not None and state.conn is not None:
+            return state.conn
+        if read and self._replicas and state is None and not self._use_primary.get():
+            return self.__replica_connection()
+        if self._listeners:
+            start = time.perf_counter()
+            conn = self._datasource.connection()
+            self._notify('on_checkout', conn, time.perf_counter() - start)
+        else:
+            conn = self._datasource.connection()
+        if state is not None:
+            self._transaction_ctx.init_conn_maybe(conn)
+        return conn
+
+    def __replica_connection(self):
+        with self._replica_lock:
+            if self._balance == 'least_outstanding':
+                index = min(range(len(self._replicas)), key=self._outstanding.__getitem__)
+            else:
+                index = next(self._round_robin) % len(self._replicas)
+            self._outstanding[index] += 1
+        try:
+            start = time.perf_counter()
+            conn = self._replicas[index].connection()
+        except Exception:
+            self.__release_replica(index)
+            raise
+        conn._dbtool_replica = index
+        if self._listeners:
+            self._notify('on_checkout', conn, time.perf_counter() - start)
         return conn
 
-    def transaction(self, func=None):
+    def __release_replica(self, index):
+        with self._replica_lock:
+            self._outstanding[index] -= 1
+
+    @contextlib.contextmanager
+    def use_primary(self):
+        """route select statements to primary in the context, for read-your-writes."""
+        token = self._use_primary.set(True)
+        try:
+            yield self
+        finally:
+            self._use_primary.reset(token)
+
+    def warm_up(self, connections=None):
+        """open idle connections in the pools of primary and replicas ahead of the first requests, thread local
+        mode opens the connection of current thread, returns the number of connections opened.
+        :param connections: number of idle connections of every pool (None means mincached, or maxconnections if
+            mincached is 0, or 1 if both are 0)
+        """
+        connections = connections or self._mincached or self._maxconnections or 1
+        return sum(pool.warm_up(connections) for pool in [self._datasource] + self._replicas)
+
+    def pool_status(self):
+        """returns connections status of the pool: in_use, idle, waiting, max, created and reaped counts, with
+        status of replica pools in replicas."""
+        status = self._datasource.status()
+        if self._replicas:
+            status['replicas'] = [pool.status() for pool in self._replicas]
+        return status
+
+    def close(self):
+        """close idle connections and stop reaping of the pools, shutdown the gather executor."""
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+        for pool in [self._datasource] + self._replicas:
+            pool.close()
+
+    def __cursor(self, conn, server_side=False, raw=False, lean=False):
+        """open a cursor with row factory, server side cursor fetch rows from server lazily if driver supports,
+        raw cursor returns rows as tuple, or sqlite3.Row if raw is sqlite3.Row.
+        Lean sqlite cursor is the driver cursor of the pooled connection, without the dbutils cursor wrapper."""
+        if self._dbms == 'sqlite':
+            if lean:
+                cursor = _steady_connection(conn)._con.cursor()
+                if raw:
+                    cursor.row_factory = raw if _is_sqlite_row(raw) else None
+                return cursor
+            cursor = conn.cursor()
+            if raw:
+                cursor._cursor.row_factory = raw if _is_sqlite_row(raw) else None
+            return cursor
+        if _is_sqlite_row(raw):
+            raise Exception('sqlite3.Row is unsupported by dbms:' + self._dbms)
+        if not self._row_factory and not raw:
+            return conn.cursor()
+        if self._dbms == 'postgresql' and server_side:
+            kwargs = {} if raw else {'cursor_factory': self._row_factory}
+            return conn.cursor('dbtool_cursor_%x' % next(_cursor_counter), **kwargs)
+        key = (bool(raw), server_side)
+        options = self._cursor_options.get(key)
+        if options is None:
+            options = self._cursor_options[key] = self.__resolve_cursor_options(bool(raw), server_side)
+        args, kwargs = options
+        return conn.cursor(*args, **kwargs)
+
+    def __resolve_cursor_options(self, raw, server_side):
+        """returns (args, kwargs) of connection cursor method, resolved once per raw and server side."""
+        if self._dbms == 'mysql':
+            cursors = importlib.import_module('pymysql.cursors')
+            cursor_class = cursors.Cursor if raw else self._row_factory
+            if server_side and not issubclass(cursor_class, cursors.SSCursor):
+                is_dict = issubclass(cursor_class, cursors.DictCursorMixin)
+                cursor_class = cursors.SSDictCursor if is_dict else cursors.SSCursor
+            return (cursor_class,), {}
+        elif self._dbms == 'postgresql':
+            return (), ({} if raw else {'cursor_factory': self._row_factory})
+        elif self._dbms == 'sqlserver':
+            return (), {'as_dict': not raw}
+        return (), {}
+
+    def __reused_cursor(self, conn, raw):
+        """returns the cursor kept by the pooled connection for the rows type, see reuse_cursors."""
+        steady = _steady_connection(conn)
+        cursors = steady.__dict__.get('_dbtool_cursors')
+        if cursors is None or cursors[0] is not steady._con:
+            cursors = steady._dbtool_cursors = (steady._con, {})
+        key = raw if _is_sqlite_row(raw) else bool(raw)
+        cursor = cursors[1].get(key)
+        if cursor is None:
+            cursor = cursors[1][key] = self.__cursor(conn, raw=raw, lean=True)
+        return cursor
+
+    def __discard_cursor(self, conn, cursor):
+        """close the reused cursor of connection, the next execute opens a new one."""
+        cursors = _steady_connection(conn).__dict__.get('_dbtool_cursors')
+        if cursors is not None:
+            for key, value in list(cursors[1].items()):
+                if value is cursor:
+                    del cursors[1][key]
+        cursor.close()
+
+    def transaction(self, func=None, retry=0, backoff=0.05, max_backoff=2.0):
+        """returns transaction context, or decorate function run in transaction, nested one is a savepoint.
+        :param retry: times to re-run the decorated function failed by transient errors, like sqlite database is
+            locked, deadlock or serialization failure, only the outermost transaction re-runs
+        :param backoff: seconds of the first retry delay, doubled every retry and jittered
+        :param max_backoff: maximum seconds of a retry delay
+        """
         if func is None:
-            return self.__transaction_ctx
+            if retry:
+                return lambda f: self.transaction(f, retry, backoff, max_backoff)
+            return self._transaction_ctx
+        if not retry:
+            def wrapper(*args, **kw):
+                with self._transaction_ctx:
+                    return func(*args, **kw)
+
+            return wrapper
+
+        def retry_wrapper(*args, **kw):
+            for attempt in itertools.count():
+                outermost = self._transaction_ctx.state is None
+                try:
+                    with self._transaction_ctx:
+                        result = func(*args, **kw)
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt, retry, backoff, max_backoff) if outermost else None
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                else:
+                    if attempt:
+                        self._count_retry('recovered')
+                    return result
+
+        return retry_wrapper
+
+    def retry_stats(self):
+        """returns counters of transaction retries: retries, recovered and exhausted transactions."""
+        with self._retry_lock:
+            return dict(self._retries)
+
+    def _retry_delay(self, error, attempt, retry, backoff, max_backoff):
+        """returns seconds to wait before re-run the transaction failed by error, None if it should not re-run."""
+        if not _is_transient_error(self._dbms, error):
+            return None
+        if attempt >= retry:
+            self._count_retry('exhausted')
+            return None
+        self._count_retry('retries')
+        return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
 
-        def wrapper(*args, **kw):
-            with self.__transaction_ctx:
-                return func(*args, **kw)
+    def _count_retry(self, key):
+        with self._retry_lock:
+            self._retries[key] += 1
 
-        return wrapper
+    def _begin(self, conn):
+        """begin transaction on conn, sqlite3 has no begin() and begins implicitly before writes only."""
+        conn.begin()
+        if self._dbms == 'sqlite':
+            driver_conn = _steady_connection(conn)._con
+            if not driver_conn.in_transaction:
+                driver_conn.execute('BEGIN')
+
+    def _savepoint(self, action, name):
+        """create, release or rollback to the savepoint of current transaction."""
+        conn = self.__connection()
+        cursor = conn.cursor()
+        try:
+            for sql in _SAVEPOINT_SQL['sqlserver' if self._dbms == 'sqlserver' else None][action]:
+                cursor.execute(sql % name)
+        finally:
+            cursor.close()
 
-    def execute(self, sql, args=()):
-        """execute sql, like select, insert, update, delete, ... statement."""
-        return self._execute(sql, args)
+    def execute(self, sql, args=(), row_type=None):
+        """execute sql, like select, insert, update, delete, ... statement.
+        :param row_type: the returned rows type: dict, tuple, dbtool.Row, sqlite3.Row or entity class
+        """
+        return self._execute(sql, args, row_type=row_type)
 
     def _execute(self, sql, args=(), fetchone=False, return_cursor=False, batch=False, script=False,
-                 handel_placeholder=None):
-        handel_placeholder = handel_placeholder if handel_placeholder is not None else self._handle_placeholder
-        sql = sql if not handel_placeholder else self.__handle_replacer(sql)
-        conn, cursor = self.__connection(), None
+                 handel_placeholder=None, returning=False, row_type=None):
+        statement = self.__statement(sql, handel_placeholder)
+        row_type = self.__row_type(row_type)
+        args = tuple(args)
+        listeners = self._listeners
+        conn, cursor, start = self.__connection(statement.is_select), None, None
+        reused = self._reuse_cursors and not return_cursor
         try:
-            cursor = conn.cursor()
+            if reused:
+                cursor = self.__reused_cursor(conn, row_type)
+            else:
+                cursor = self.__cursor(conn, raw=row_type, lean=not return_cursor)
+            if listeners:
+                start = self.__before_execute(listeners, statement, args)
             if script and self._dbms == 'sqlite':
-                cursor.executescript(sql)
+                cursor.executescript(statement.sql)
             elif batch:
-                cursor.executemany(sql, tuple(args))
+                cursor.executemany(statement.sql, args)
+            elif self._prepared is not None and not return_cursor and not script:
+                self.__execute_prepared(conn, cursor, statement, args)
             else:
-                cursor.execute(sql, tuple(args))
-            statement = _SqlStatement(sql)
+                cursor.execute(statement.sql, args)
             if not statement.is_select and not conn._transaction:
                 conn.commit()
+            if (self.result_cache is not None or self.count_cache is not None) and not statement.is_select:
+                self._invalidate_results(None if script else _written_tables(statement.sql))
 
             if script:
-                return None
+                result = None
             elif return_cursor:
                 cursor._dbutils_connection = conn
                 return_cursor = True
-                return cursor
+                result = cursor
+            elif returning:
+                result = cursor.fetchall()
             elif fetchone:
-                return cursor.fetchone()
+                row = cursor.fetchone()
+                mapper = _row_mapper(row_type, cursor.description) if row is not None else None
+                result = row if mapper is None else mapper(row)
+                if reused and row is not None and self._dbms == 'sqlite' and cursor.fetchone() is not None:
+                    # the active statement of unread rows holds the read lock of database
+                    reused = False
             elif statement.is_select:
-                return cursor.fetchall()
+                mapper = _row_mapper(row_type, cursor.description)
+                result = cursor.fetchall() if mapper is None else list(map(mapper, cursor))
             elif not batch and statement.is_lastrowid:
-                return cursor.lastrowid
+                result = cursor.lastrowid
             else:
-                return cursor.rowcount
+                result = cursor.rowcount
+            if start is not None:
+                elapsed, start = time.perf_counter() - start, None
+                if type(result) is list:
+                    rows = len(result)
+                elif fetchone:
+                    rows = int(result is not None)
+                else:
+                    rows = cursor.rowcount
+                self.__after_execute(listeners, statement, args, elapsed, rows, None)
+            return result
+        except Exception as e:
+            if start is not None:
+                self.__after_execute(listeners, statement, args, time.perf_counter() - start, None, e)
+            raise
         finally:
-            if cursor and not return_cursor:
-                cursor.close()
+            if cursor and not return_cursor and not reused:
+                if self._reuse_cursors:
+                    self.__discard_cursor(conn, cursor)
+                else:
+                    cursor.close()
             if not return_cursor:
                 self.__close_connection(conn)
 
-    def execute_fetchone(self, sql, args=()):
-        """execute sql, returns one row."""
-        return self._execute(sql, args, fetchone=True)
+    def __execute_prepared(self, conn, cursor, statement, args):
+        """execute statement by the prepared statement of connection, prepare it by PREPARE at first, the least
+        recently used one is deallocated beyond the limit. Statements PREPARE does not accept run directly."""
+        if statement.type not in _PREPARED_TYPES or self._prepared_limit == 0:
+            return cursor.execute(statement.sql, args)
+        raw = _steady_connection(conn)._con
+        prepared = self._prepared.get(raw)
+        if prepared is None:
+            prepared = self._prepared[raw] = collections.OrderedDict()
+        name = prepared.get(statement.sql)
+        if name is None:
+            if self._prepared_limit is not None and len(prepared) >= self._prepared_limit:
+                cursor.execute('DEALLOCATE ' + prepared.popitem(last=False)[1])
+            name = 'dbtool_%x' % next(_cursor_counter)
+            cursor.execute(f'PREPARE {name} AS {_numbered_placeholders(statement.sql)}')
+            prepared[statement.sql] = name
+        else:
+            prepared.move_to_end(statement.sql)
+        if args:
+            return cursor.execute(f'EXECUTE {name} (' + ', '.join(['%s'] * len(args)) + ')', args)
+        return cursor.execute(f'EXECUTE {name}')
+
+    @staticmethod
+    def __before_execute(listeners, statement, args):
+        for listener in listeners:
+            listener.before_execute(statement, args)
+        return time.perf_counter()
+
+    @staticmethod
+    def __after_execute(listeners, statement, args, elapsed, rows, error):
+        for listener in listeners:
+            listener.after_execute(statement, args, elapsed, rows, error)
+
+    def execute_iter(self, sql, args=(), chunk_size=1000, row_type=None):
+        """execute query sql, returns iterator of rows fetched in chunks.
+        Server side cursor is used if the driver supports, the connection is released when the iterator is
+        exhausted, closed or garbage collected.
+        :param chunk_size: number of rows fetched each time
+        :param row_type: the returned rows type, see execute
+        """
+        chunks = self._execute_chunks(sql, args, chunk_size, row_type=row_type)
+        try:
+            for rows in chunks:
+                yield from rows
+        finally:
+            chunks.close()
+
+    def execute_columns(self, sql, args=(), chunk_size=10000, as_numpy=False):
+        """execute query sql, returns dict of {column: values}, rows are streamed from cursor to column buffers.
+        :param chunk_size: number of rows fetched each time
+        :param as_numpy: returns values as numpy array with inferred dtype, requires numpy
+        """
+        result = None
+        for chunk in self._execute_chunks(sql, args, chunk_size, columns=True):
+            if result is None:
+                result = chunk
+            else:
+                for column, values in chunk.items():
+                    result[column].extend(values)
+        return _numpy_columns(result) if as_numpy else result
+
+    def execute_columns_iter(self, sql, args=(), chunk_size=10000, as_numpy=False):
+        """execute query sql, returns iterator of dict of {column: values} for every chunk, see execute_columns."""
+        chunks = self._execute_chunks(sql, args, chunk_size, columns=True)
+        try:
+            for chunk in chunks:
+                yield _numpy_columns(chunk) if as_numpy else chunk
+        finally:
+            chunks.close()
+
+    def _execute_chunks(self, sql, args=(), chunk_size=1000, row_type=None, columns=False):
+        """execute query sql, returns iterator of rows list fetched by fetchmany,
+        or dict of {column: values list} if columns, at least one for empty result."""
+        statement = self.__statement(sql)
+        row_type = tuple if columns else self.__row_type(row_type)
+        args = tuple(args)
+        listeners = self._listeners
+        conn, cursor, start = self.__connection(statement.is_select), None, None
+        try:
+            cursor = self.__cursor(conn, server_side=True, raw=row_type)
+            if listeners:
+                start = self.__before_execute(listeners, statement, args)
+            try:
+                cursor.execute(statement.sql, args)
+            except Exception as e:
+                if start is not None:
+                    self.__after_execute(listeners, statement, args, time.perf_counter() - start, None, e)
+                raise
+            if start is not None:
+                self.__after_execute(listeners, statement, args, time.perf_counter() - start, None, None)
+            mapper, empty = None, True
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if columns and (rows or empty):
+                    names = [column[0] for column in cursor.description]
+                    values = list(zip(*rows)) if rows else [()] * len(names)
+                    rows = {name: list(column) for name, column in zip(names, values)}
+                    empty = False
+                elif not rows:
+                    break
+                elif row_type is not None:
+                    mapper = mapper or _row_mapper(row_type, cursor.description)
+                    rows = rows if mapper is None else list(map(mapper, rows))
+                yield rows
+        finally:
+            if cursor:
+                cursor.close()
+            self.__close_connection(conn)
+
+    def execute_fetchone(self, sql, args=(), row_type=None):
+        """execute sql, returns one row.
+        :param row_type: the returned row type, see execute
+        """
+        return self._execute(sql, args, fetchone=True, row_type=row_type)
 
     def execute_cursor(self, sql, args=()):
         """execute sql, returns cursor."""
@@ -153,41 +584,195 @@ class DB:
         """execute multiples sql, split with semicolon."""
         return self._execute(sql, script=True)
 
+    def gather(self, calls, return_exceptions=False):
+        """run independent statements or crud calls concurrently, each one on its own pooled connection,
+        the executor threads are bounded by maxconnections. Not allowed in transaction.
+        :param calls: list of sql, (sql, args) or function without parameters like lambda: db.find(User)
+        :param return_exceptions: returns exception of failed call in its position, otherwise raises the
+            first exception after all calls finished
+        :return: returns list of results in order of calls
+        """
+        if self._transaction_ctx.state is not None:
+            raise Exception('gather is not allowed in transaction')
+        executor = self.__gather_executor()
+        futures = [executor.submit(contextvars.copy_context().run, self.__gather_call, call) for call in calls]
+        concurrent.futures.wait(futures)
+        results = []
+        for future in futures:
+            error = future.exception()
+            if error is not None and not return_exceptions:
+                raise error
+            results.append(error if error is not None else future.result())
+        return results
+
+    def __gather_call(self, call):
+        if callable(call):
+            return call()
+        elif isinstance(call, str):
+            return self.execute(call)
+        return self.execute(*call)
+
+    def __gather_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                workers = self._maxconnections or min(32, (os.cpu_count() or 1) + 4)
+                self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='dbtool-gather')
+            return self._executor
+
+    def add_listener(self, listener):
+        """register a listener receives execute, connection and transaction events, see Listener."""
+        self._listeners = self._listeners + (listener,)
+        return listener
+
+    def remove_listener(self, listener):
+        self._listeners = tuple(item for item in self._listeners if item is not listener)
+
+    def enable_stats(self, slow_query_threshold=None):
+        """register the built-in StatsListener, the snapshot returns by stats().
+        :param slow_query_threshold: seconds, slower statements are logged to logger 'dbtool'
+        """
+        if self._stats is not None:
+            self.remove_listener(self._stats)
+        self._stats = self.add_listener(StatsListener(slow_query_threshold))
+        return self._stats
+
+    def stats(self):
+        """returns statistics snapshot of StatsListener, empty if stats is not enabled."""
+        return self._stats.snapshot() if self._stats is not None else {}
+
+    @contextlib.contextmanager
+    def profile(self, explain_threshold=0.1, n_plus_one_threshold=10):
+        """profile statements run in the context, yields the Profiler, see Profiler.report.
+        :param explain_threshold: seconds, query plans of slower statements are captured (None means never)
+        :param n_plus_one_threshold: times a single row select runs in the context to be reported as N+1
+        """
+        profiler = self.add_listener(Profiler(self, 1.0, explain_threshold, n_plus_one_threshold, contextual=True))
+        try:
+            with profiler.scope():
+                yield profiler
+        finally:
+            self.remove_listener(profiler)
+            profiler.explain_pending()
+
+    def enable_profiler(self, sample_rate=0.01, explain_threshold=1.0, n_plus_one_threshold=10):
+        """register an always-on Profiler records a sample of statements, N+1 are detected in Profiler.scope.
+        :param sample_rate: fraction of statements recorded
+        """
+        self.disable_profiler()
+        self._profiler = self.add_listener(Profiler(self, sample_rate, explain_threshold, n_plus_one_threshold))
+        return self._profiler
+
+    def disable_profiler(self):
+        if self._profiler is not None:
+            self.remove_listener(self._profiler)
+            self._profiler = None
+
+    def explain(self, sql, args=()):
+        """returns the query plan rows of sql as tuples, by EXPLAIN QUERY PLAN on sqlite, EXPLAIN on others."""
+        prefix = _EXPLAIN_PREFIXES.get(self._dbms)
+        if prefix is None:
+            raise Exception('explain is unsupported by dbms:' + self._dbms)
+        return self.__explain(prefix, self.__statement(sql), args)[1]
+
+    def __explain(self, prefix, statement, args):
+        """returns column names and rows of tuple of the query plan by the explain prefix."""
+        cursor = self._execute(_SqlStatement(prefix + statement.sql), args, return_cursor=True, row_type=tuple)
+        try:
+            return [column[0] for column in cursor.description], cursor.fetchall()
+        finally:
+            self.close_cursor(cursor)
+
+    def session(self, id_column='id', batch_size=500):
+        """returns a new unit of work with identity map, see Session."""
+        return Session(self, id_column, batch_size)
+
+    def writer(self, table=None, batch_size=1000, flush_interval=1.0, max_queue=10000, **options):
+        """returns a write-behind writer inserts queued rows in batches by a background thread, see Writer."""
+        return Writer(self, table, batch_size, flush_interval, max_queue, **options)
+
+    def enable_result_cache(self, ttl=60, maxsize=1024, backend=None, tables=None):
+        """cache results of find and find_one called out of transaction, see find_count for cached counts. Writes
+        of this DB invalidate the cached results of written tables, or all tables if unknown, in transaction after
+        commit.
+        :param ttl: seconds a result is cached, None means no expiration
+        :param maxsize: maximum number of results of the default memory backend
+        :param backend: the cache storage, see CacheBackend
+        :param tables: names of cached tables, None means all tables
+        :return: the ResultCache, see ResultCache.info
+        """
+        self.result_cache = ResultCache(ttl, maxsize, backend, tables)
+        return self.result_cache
+
+    def disable_result_cache(self):
+        self.result_cache = None
+
+    def _invalidate_results(self, tables):
+        """invalidate cached results and counts of tables, None means all tables, deferred until commit in
+        transaction."""
+        if self.result_cache is None and self.count_cache is None:
+            return
+        state = self._transaction_ctx.state
+        if state is not None:
+            state.tables.update(tables if tables is not None else (None,))
+            return
+        for cache in (self.result_cache, self.count_cache):
+            if cache is not None:
+                cache.invalidate(tables)
+
+    def _notify(self, event, *args):
+        for listener in self._listeners:
+            getattr(listener, event)(*args)
+
     def close_cursor(self, cursor):
         cursor.close()
         if cursor._dbutils_connection:
             self.__close_connection(cursor._dbutils_connection)
 
+    def __row_type(self, row_type):
+        """returns the rows type, None means rows created by row_factory."""
+        row_type = row_type if row_type is not None else self._row_type
+        return None if row_type is dict and self._dict_rows else row_type
+
+    def __statement(self, sql, handel_placeholder=None):
+        """returns statement of sql, the compiled statement returns directly."""
+        if isinstance(sql, _SqlStatement):
+            return sql
+        if handel_placeholder is not None and handel_placeholder != self._handle_placeholder:
+            return _SqlStatement(self.__handle_replacer(sql) if handel_placeholder else sql)
+        return self.__cached_statement(sql)
+
+    def __cached_statement(self, sql):
+        """returns statement of sql, with rewritten placeholder if handle placeholder, cached by the source sql."""
+        statement = self.placeholder_cache.get(sql)
+        if statement is None:
+            statement = _SqlStatement(self.__handle_replacer(sql) if self._handle_placeholder else sql)
+            self.placeholder_cache.put(sql, statement)
+        return statement
+
     def __handle_replacer(self, sql):
-        """Replace sql replacer ? with driver replacer character."""
-        chars = []
-        for c in sql:
-            if c != '?':
-                chars.append(c)
-            else:
-                chars.append(self._placeholder)
-        return ''.join(chars)
+        """Replace sql replacer ? with driver replacer character, skip quoted strings, comments and ?| ?& operators."""
+        return _replace_placeholder(sql, self._placeholder, self._placeholder_pattern)
 
-    @staticmethod
-    def __close_connection(conn):
+    def __close_connection(self, conn):
         """close a connection."""
         if conn and not conn._transaction:
+            replica = conn.__dict__.get('_dbtool_replica') if self._replicas else None
             conn.close()
+            if replica is not None:
+                self.__release_replica(replica)
+            if self._listeners:
+                self._notify('on_checkin', conn)
 
-    @staticmethod
-    def __dict_factory(cursor, row):
-        """a row factory to dict."""
-        d = {}
-        for idx, col in enumerate(cursor.description):
-            d[col[0]] = row[idx]
-        return d
+    __dict_factory_columns = (None, ())
 
     @staticmethod
-    def __sqlite3_connect(connect=None, row_factory=None, **kwargs):
-        """wrap sqlite3 connect method for set row_factory"""
-        conn = connect(**kwargs)
-        conn.row_factory = row_factory
-        return conn
+    def __dict_factory(cursor, row):
+        """a row factory to dict, column names are computed once per cursor description."""
+        description = cursor.description
+        memo = DB.__dict_factory_columns
+        if memo[0] is not description:
+            memo = DB.__dict_factory_columns = (description, tuple(col[0] for col in description))
+        return dict(zip(memo[1], row))
 
     # ------------------ CRUD ------------------#
 
@@ -195,13 +780,15 @@ class DB:
         """ insert one row.
         :return: returns autogenerate id
         """
-        table_name = self.__table_name(type(data), table)
         data_dict = self.__data2dict(data)
-        k_snippet = ', '.join(data_dict.keys())
-        v_snippet = ', '.join([self._placeholder] * len(data_dict.keys()))
-        sql = f'INSERT INTO {table_name}({k_snippet}) VALUES({v_snippet})'
-        args = data_dict.values()
-        return self._execute(sql, args, handel_placeholder=False)
+        key = ('INSERT', table or type(data), tuple(data_dict.keys()), self._dbms)
+        statement = self.statement_cache.get(key)
+        if statement is None:
+            table_name = self.__table_name(type(data), table)
+            k_snippet = ', '.join(data_dict.keys())
+            v_snippet = ', '.join([self._placeholder] * len(data_dict.keys()))
+            statement = self.__compile(key, f'INSERT INTO {table_name}({k_snippet}) VALUES({v_snippet})')
+        return self._execute(statement, data_dict.values())
 
     def update(self, data, table=None, id_column='id'):
         """ update one row.
@@ -210,102 +797,588 @@ class DB:
         :param id_column: the primary column name
         :return: returns effective rows counts
         """
-        table_name = self.__table_name(type(data), table)
         data_dict = self.__data2dict(data)
         d = DB.__filter_dict(data_dict, excludes=(id_column,))
         id_value = data_dict[id_column]
-
-        set_snippet = ', '.join(list(map(lambda k: k + '=' + self._placeholder, d.keys())))
-        sql = f'UPDATE {table_name} SET {set_snippet} WHERE {id_column} = {self._placeholder}'
+        key = ('UPDATE', table or type(data), tuple(d.keys()), self._dbms, id_column)
+        statement = self.statement_cache.get(key)
+        if statement is None:
+            table_name = self.__table_name(type(data), table)
+            set_snippet = ', '.join(list(map(lambda k: k + '=' + self._placeholder, d.keys())))
+            sql = f'UPDATE {table_name} SET {set_snippet} WHERE {id_column} = {self._placeholder}'
+            statement = self.__compile(key, sql)
         args = (*d.values(), id_value)
-        return self._execute(sql, args, handel_placeholder=False)
+        return self._execute(statement, args)
 
     def delete(self, table, filters):
         """delete rows by id.
         :param table: the table name or entity class
-        :param filters: the query conditions
+        :param filters: the query conditions, see find
         :return: returns effective rows counts
         """
-        table_name = self.__table_name(None, table)
-        where = self.__build_where_snippet(filters)
-        sql = f'DELETE FROM {table_name} {where}'
-        args = filters.values()
-        return self._execute(sql, args, handel_placeholder=False)
+        shape, args = _filter_shape(filters)
+        key = ('DELETE', table, shape, self._dbms)
+        statement = self.statement_cache.get(key)
+        if statement is None:
+            table_name = self.__table_name(None, table)
+            where = self.__build_where_snippet(shape)
+            statement = self.__compile(key, f'DELETE FROM {table_name} {where}')
+        return self._execute(statement, args)
 
-    def find(self, table, filters={}, return_type=None):
+    def find(self, table, filters={}, return_type=None, columns=None, order_by=None, limit=None, offset=None):
         """find rows by query.
         :param table: the table name or entity class
-        :param filters: the query conditions
+        :param filters: the query conditions, key is column name with optional operator suffix: __ne, __gt,
+            __gte, __lt, __lte, __like, __in, __not_in, __isnull, e.g. {'age__gte': 18, 'id__in': [1, 2]}
         :param return_type: the return rows type
+        :param columns: the selected column names, default all columns
+        :param order_by: column names sort rows, prefix - means descending, e.g. ('-age', 'id')
+        :param limit: maximum number of rows
+        :param offset: number of rows skipped
+        """
+        return_type = self.__return_type(table, return_type)
+        statement, args = self.__select(table, filters, columns, order_by, limit, offset)
+        return self.__query(table, statement, args, return_type)
+
+    def find_iter(self, table, filters={}, return_type=None, chunk_size=1000, columns=None, order_by=None, limit=None,
+                  offset=None):
+        """find rows by query, returns iterator of rows fetched in chunks, see execute_iter.
+        :param table: the table name or entity class
+        :param filters: the query conditions, see find
+        :param return_type: the return rows type
+        :param chunk_size: number of rows fetched each time
+        :param columns: the selected column names, see find
+        :param order_by: column names sort rows, see find
+        :param limit: maximum number of rows
+        :param offset: number of rows skipped
+        """
+        chunks = self._find_chunks(table, filters, return_type, chunk_size, columns, order_by, limit, offset)
+        try:
+            for rows in chunks:
+                yield from rows
+        finally:
+            chunks.close()
+
+    def _find_chunks(self, table, filters={}, return_type=None, chunk_size=1000, columns=None, order_by=None,
+                     limit=None, offset=None):
+        """find rows by query, returns iterator of rows list, see _execute_chunks."""
+        return_type = self.__return_type(table, return_type)
+        statement, args = self.__select(table, filters, columns, order_by, limit, offset)
+        return self._execute_chunks(statement, args, chunk_size, row_type=return_type)
+
+    def find_pages(self, table, filters={}, order_by='id', page_size=100, return_type=None, columns=None):
+        """find rows by keyset pagination, returns iterator of rows list, one query each page and no connection is
+        held between pages. Each page seeks rows after the last row of previous page instead of skipping offset rows.
+        :param table: the table name or entity class
+        :param filters: the query conditions, see find
+        :param order_by: column names sort rows, see find, the columns should identify a row, e.g. ends with id
+        :param page_size: number of rows each page
+        :param return_type: the return rows type, not tuple
+        :param columns: the selected column names, must contain order_by columns
         """
-        table_name = self.__table_name(None, table)
         return_type = self.__return_type(table, return_type)
-        where = self.__build_where_snippet(filters)
-        sql = f'SELECT * FROM {table_name} {where}'
-        args = filters.values()
-        rows = self._execute(sql, args, handel_placeholder=False)
-        return rows if return_type is None else [self.__create_object(row, return_type) for row in rows]
-
-    def __build_where_snippet(self, keys):
-        snippet = ' AND '.join(list(map(lambda k: k + '=' + self._placeholder, keys.keys())))
+        order_by = _column_names(order_by)
+        if not order_by:
+            raise Exception('Keyset pagination requires order_by columns')
+        renames = getattr(return_type, 'COLUMN_MAP', None) or {}
+        keys = [renames.get(c.lstrip('-'), c.lstrip('-')) for c in order_by]
+        seek = None
+        while True:
+            statement, args = self.__select(table, filters, columns, order_by, page_size, None, seek)
+            rows = self._execute(statement, args, row_type=return_type)
+            if rows:
+                yield rows
+            if len(rows) < page_size:
+                return
+            seek = [_row_value(rows[-1], key) for key in keys]
+
+    def __build_where_snippet(self, shape, *conditions):
+        """returns where snippet of filters shape, see _filter_shape."""
+        snippets = []
+        for item in shape:
+            key, value = item if type(item) is tuple else (item, None)
+            column, _, op = key.rpartition('__')
+            if not column or op not in _FILTER_OPERATORS:
+                snippets.append(key + '=' + self._placeholder)
+            elif op == 'isnull':
+                snippets.append(column + (' IS NULL' if value else ' IS NOT NULL'))
+            elif op == 'in' or op == 'not_in':
+                if value:
+                    snippets.append(column + _FILTER_OPERATORS[op] + '(' + ', '.join([self._placeholder] * value) + ')')
+                else:
+                    snippets.append('1=0' if op == 'in' else '1=1')
+            else:
+                snippets.append(column + _FILTER_OPERATORS[op] + self._placeholder)
+        snippet = ' AND '.join(snippets + list(conditions))
         if snippet:
             snippet = 'WHERE ' + snippet
         return snippet
 
-    def find_one(self, table, filters, return_type=None):
+    def __seek_snippet(self, order_by):
+        """returns keyset condition rows after the seek values, e.g. (a>?) OR (a=? AND b<?) of order by a, -b."""
+        snippets = []
+        for i, column in enumerate(order_by):
+            equals = [c.lstrip('-') + '=' + self._placeholder for c in order_by[:i]]
+            op = '<' if column.startswith('-') else '>'
+            snippets.append('(' + ' AND '.join(equals + [column.lstrip('-') + op + self._placeholder]) + ')')
+        return '(' + ' OR '.join(snippets) + ')'
+
+    def find_one(self, table, filters, return_type=None, columns=None, order_by=None):
         """find one row by query.
         :param table: the table name or entity class
-        :param filters: the query conditions
+        :param filters: the query conditions, see find
         :param return_type: the return rows type
+        :param columns: the selected column names, see find
+        :param order_by: column names sort rows, see find
         """
-        table_name = self.__table_name(None, table)
         return_type = self.__return_type(table, return_type)
-        where = self.__build_where_snippet(filters)
-        sql = f'SELECT * FROM {table_name} {where}'
-        args = filters.values()
-        row = self._execute(sql, args, fetchone=True, handel_placeholder=False)
-        return row if return_type is None else self.__create_object(row, return_type)
+        statement, args = self.__select(table, filters, columns, order_by, 1)
+        return self.__query(table, statement, args, return_type, fetchone=True)
 
-    def find_count(self, filters={}, table=None):
+    def find_count(self, filters={}, table=None, strategy=None, ttl=None):
         """count rows by query.
-        :param filters: the query conditions
+        :param filters: the query conditions, see find
         :param table: the table name or entity class
-        :returns count result of type int
+        :param strategy: exact: count(*) query; cached: count(*) result cached ttl seconds, invalidated by writes of
+            this DB to the table; estimate: planner statistics, the catalog row count of table without filters or
+            the EXPLAIN row estimate with filters, exact if unavailable
+            (None means the strategy set by count_strategy for the table, exact by default)
+        :param ttl: seconds a cached count lives (None means the ttl set by count_strategy, 60 by default)
+        :returns Count, an int reports the strategy used and the age: seconds the count may be stale
         """
-        table_name = self.__table_name(None, table)
-        where = self.__build_where_snippet(filters)
-        sql = f'SELECT count(*) total FROM {table_name} {where}'
-        args = filters.values()
-        row = self._execute(sql, args, fetchone=True, handel_placeholder=False)
-        if type(row) == list or type(row) == tuple:
-            return row[0]
+        shape, args = _filter_shape(filters)
+        key = ('COUNT', table, shape, self._dbms)
+        statement = self.statement_cache.get(key)
+        if statement is None:
+            table_name = self.__table_name(None, table)
+            where = self.__build_where_snippet(shape)
+            statement = self.__compile(key, f'SELECT count(*) total FROM {table_name} {where}')
+        if strategy is not None or self._count_strategies:
+            table_name = self.__table_name(None, table)
+            default_strategy, default_ttl = self._count_strategies.get(table_name.lower(), ('exact', 60))
+            strategy = strategy or default_strategy
+            ttl = ttl if ttl is not None else default_ttl
+            if strategy not in _COUNT_STRATEGIES:
+                raise Exception('unsupported count strategy:' + strategy)
+            if strategy == 'cached' and self._transaction_ctx.state is None:
+                return self.__cached_count(table_name, statement, args, ttl)
+            if strategy == 'estimate':
+                count = self.__estimate_count(table, table_name, shape, args)
+                if count is not None:
+                    return count
+        # an exact count bypasses the result cache, cached counts are reported by the cached strategy
+        return Count(self._execute(statement, args, fetchone=True, row_type=tuple)[0])
+
+    def count_strategy(self, table, strategy='exact', ttl=60):
+        """set the default strategy and ttl of find_count for the table, see find_count."""
+        if strategy not in _COUNT_STRATEGIES:
+            raise Exception('unsupported count strategy:' + strategy)
+        table_name = self.__table_name(None, table).lower()
+        if strategy == 'exact':
+            self._count_strategies.pop(table_name, None)
         else:
-            return row['total']
+            self._count_strategies[table_name] = (strategy, ttl)
 
-    def __table_name(self, data_type, table):
-        if type(table) is str:
-            return table
+    def __cached_count(self, table_name, statement, args, ttl):
+        """returns Count of the count(*) statement cached in count_cache."""
+        cache = self.count_cache
+        if cache is None:
+            cache = self.count_cache = ResultCache(ttl)
+        key = (statement.sql, tuple(args))
+        value = cache.get(key)
+        now = time.monotonic()
+        if value is None:
+            generation = cache.generation(table_name)
+            value = (self._execute(statement, args, fetchone=True, row_type=tuple)[0], now)
+            cache.put(key, value, table_name, generation, ttl)
+        return Count(value[0], 'cached', 'cache', now - value[1])
+
+    def __estimate_count(self, table, table_name, shape, args):
+        """returns Count estimated by planner statistics, None if unavailable."""
+        try:
+            if shape:
+                return self.__explain_count(table, table_name, shape, args)
+            source, sql = _COUNT_ESTIMATES.get(self._dbms, (None, None))
+            if sql is None:
+                return None
+            row = self._execute(_SqlStatement(sql), (table_name,), fetchone=True, row_type=tuple)
+        except Exception as e:
+            _logger.debug('estimate count of %s failed: %s', table_name, e)
+            return None
+        if row is None or row[0] is None:
+            return None
+        value = int(str(row[0]).split()[0]) if self._dbms == 'sqlite' else int(row[0])
+        age = float(row[1]) if len(row) > 1 and row[1] is not None else None
+        return Count(value, 'estimate', source, age) if value >= 0 else None
+
+    def __explain_count(self, table, table_name, shape, args):
+        """returns Count of the EXPLAIN row estimate of filtered rows, None if the dbms has no estimate."""
+        if self._dbms not in ('postgresql', 'mysql'):
+            return None
+        key = ('COUNT_ESTIMATE', table, shape, self._dbms)
+        statement = self.statement_cache.get(key)
+        if statement is None:
+            statement = self.__compile(key, f'SELECT 1 FROM {table_name} {self.__build_where_snippet(shape)}')
+        if self._dbms == 'postgresql':
+            plan = self.__explain('EXPLAIN (FORMAT JSON) ', statement, args)[1][0][0]
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+            return Count(int(plan[0]['Plan']['Plan Rows']), 'estimate', 'explain', None)
+        columns, rows = self.__explain('EXPLAIN ', statement, args)
+        row = dict(zip(columns, rows[0]))
+        estimate = float(row['rows'] or 0) * float(row.get('filtered') or 100) / 100
+        return Count(round(estimate), 'estimate', 'explain', None)
+
+    def __query(self, table, statement, args, row_type, fetchone=False):
+        """execute select statement of table, the result is read from the result cache if it is enabled, cached
+        results are kept as tuples and converted to the rows type on every hit."""
+        cache = self.result_cache
+        if cache is None or self._transaction_ctx.state is not None:
+            return self._execute(statement, args, fetchone=fetchone, row_type=row_type)
+        target = row_type if row_type is not None else self._row_type
+        if target is None and self._dict_rows:
+            target = dict
+        table_name = self.__table_name(None, table)
+        if target is None or _is_sqlite_row(target) or not cache.cacheable(table_name):
+            return self._execute(statement, args, fetchone=fetchone, row_type=row_type)
+        key = (statement.sql, tuple(args))
+        value = cache.get(key)
+        if value is None:
+            generation = cache.generation(table_name)
+            rows = self._execute(statement, args, fetchone=fetchone, row_type=Row)
+            rows = ([rows] if rows is not None else []) if fetchone else rows
+            value = (rows[0]._columns if rows else (), tuple(map(tuple, rows)))
+            cache.put(key, value, table_name, generation)
+        columns, rows = value
+        mapper = _row_mapper(target, [(column,) for column in columns]) if rows else None
+        rows = list(rows) if mapper is None else list(map(mapper, rows))
+        if fetchone:
+            return rows[0] if rows else None
+        return rows
+
+    def insert_many(self, rows, table=None, batch_size=1000, return_ids=False, id_column='id'):
+        """ insert rows with multi-row VALUES statements, each batch runs in one transaction.
+        :param rows: iterable of dict or object instant, grouped by their columns
+        :param table: the table name or entity class
+        :param batch_size: maximum rows of one batch
+        :param return_ids: returns autogenerate ids in input order instead of effective rows counts, mysql ids are
+            computed from the first id and @@auto_increment_increment, as a multi-row insert gets consecutive ids
+        :param id_column: the primary column name, it is generated if its value is None
+        :return: returns effective rows counts, or list of ids if return_ids
+        """
+        groups = self.__group_rows(rows, table, id_column)
+        if not return_ids:
+            return sum(self.__write_batches('INSERT', groups, batch_size))
+        ids = [None] * sum(len(group[2]) for group in groups)
+        for table_key, columns, indexes, values in groups:
+            for offset, batch_ids in self.__insert_batches_returning(table_key, columns, values, batch_size, id_column):
+                for i, row_id in enumerate(batch_ids):
+                    ids[indexes[offset + i]] = row_id
+        return ids
+
+    def update_many(self, rows, table=None, id_column='id', batch_size=1000):
+        """ update rows by primary column with executemany, each batch runs in one transaction.
+        :param rows: iterable of dict or object instant, grouped by their columns
+        :param table: the table name or entity class
+        :param id_column: the primary column name
+        :param batch_size: maximum rows of one batch
+        :return: returns effective rows counts
+        """
+        groups = []
+        for table_key, columns, indexes, values in self.__group_rows(rows, table):
+            i = columns.index(id_column)
+            set_columns = columns[:i] + columns[i + 1:]
+            values = [(*row[:i], *row[i + 1:], row[i]) for row in values]
+            groups.append((table_key, set_columns, indexes, values))
+        return sum(self.__write_batches('UPDATE', groups, batch_size, id_column))
+
+    def upsert_many(self, rows, table=None, conflict_columns=('id',), update_columns=None, batch_size=1000):
+        """ insert rows, or update them when conflict with unique columns, each batch runs in one transaction.
+        :param rows: iterable of dict or object instant, grouped by their columns
+        :param table: the table name or entity class
+        :param conflict_columns: the primary or unique columns, used by sqlite and postgresql ON CONFLICT
+        :param update_columns: the columns updated on conflict, default all columns except conflict columns
+        :param batch_size: maximum rows of one batch
+        :return: returns effective rows counts
+        """
+        if self._dbms not in ('sqlite', 'postgresql', 'mysql'):
+            raise Exception('unsupported upsert dbms:' + self._dbms)
+        conflict = (tuple(conflict_columns), tuple(update_columns) if update_columns is not None else None)
+        groups = self.__group_rows(rows, table)
+        return sum(self.__write_batches('UPSERT', groups, batch_size, conflict))
+
+    def import_rows(self, table, source, format=None, columns=None, chunk_size=1000, start=0, progress=None):
+        """ insert rows streamed from csv or jsonl file, or iterable of rows, each chunk runs in one transaction,
+        postgresql loads chunks by COPY FROM STDIN.
+        :param table: the table name or entity class
+        :param source: file path, text file object or iterable of dict, entity or tuple of columns
+        :param format: csv or jsonl of file, default by file extension or csv
+        :param columns: the column names of csv without header or tuple rows, default the csv header
+        :param chunk_size: rows of one transaction
+        :param start: offset of rows skipped, e.g. the last offset reported by progress of an interrupted import
+        :param progress: function(offset) called after every committed chunk, offset counts skipped rows
+        :return: returns the offset after the last row
+        """
+        with _open_file(source, 'r') as file:
+            rows = itertools.islice(_read_rows(file, format or _file_format(source), columns), start, None)
+            offset = start
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    return offset
+                if self._dbms == 'postgresql':
+                    self.__copy_from(table, chunk)
+                else:
+                    self.insert_many(chunk, table, batch_size=chunk_size)
+                offset += len(chunk)
+                if progress is not None:
+                    progress(offset)
+
+    def export_query(self, sql, sink, args=(), format=None, chunk_size=1000, header=True, progress=None):
+        """ write rows of query sql to csv or jsonl file, rows are streamed by server side cursor, see execute_iter,
+        postgresql writes csv by COPY TO STDOUT.
+        :param sink: file path or text file object
+        :param format: csv or jsonl, default by file extension or csv
+        :param header: csv has the header of column names
+        :param progress: function(rows) called after every written chunk, once after COPY of postgresql csv
+        :return: returns number of written rows
+        """
+        format = format or _file_format(sink)
+        if format not in ('csv', 'jsonl'):
+            raise Exception('unsupported format:' + format)
+        with _open_file(sink, 'w') as file:
+            if self._dbms == 'postgresql' and format == 'csv':
+                return self.__copy_to(sql, args, file, header, progress)
+            writer = csv.writer(file) if format == 'csv' else None
+            count = 0
+            for chunk in self._execute_chunks(sql, args, chunk_size, columns=True):
+                names = list(chunk.keys())
+                if writer is not None and header and count == 0:
+                    writer.writerow(names)
+                rows = list(zip(*chunk.values()))
+                if writer is not None:
+                    writer.writerows(rows)
+                else:
+                    file.writelines(json.dumps(dict(zip(names, row)), default=str) + '\n' for row in rows)
+                count += len(rows)
+                if progress is not None and rows:
+                    progress(count)
+            return count
+
+    def __copy_from(self, table, rows):
+        """insert rows by postgresql COPY FROM STDIN in one transaction, one COPY per table and columns of rows
+        like insert_many, so missing columns get their defaults. Rows have list or tuple values (arrays of the
+        driver) are inserted by insert_many."""
+        groups = self.__group_rows(rows, table)
+        if any(isinstance(value, (list, tuple)) for group in groups for values in group[3] for value in values):
+            self.insert_many(rows, table, batch_size=len(rows))
+            return
+        table_names = set()
+        with self.transaction():
+            cursor = self.__connection().cursor()
+            try:
+                for group_table, columns, _, values in groups:
+                    buffer = io.StringIO()
+                    buffer.writelines('\t'.join(map(_copy_text, row)) + '\n' for row in values)
+                    buffer.seek(0)
+                    table_name = self.__table_name(None, group_table)
+                    cursor.copy_expert(f'COPY {table_name} ({", ".join(columns)}) FROM STDIN', buffer)
+                    table_names.add(table_name)
+            finally:
+                cursor.close()
+        self._invalidate_results(tuple(table_names))
+
+    def __copy_to(self, sql, args, file, header, progress):
+        """write rows of query by postgresql COPY TO STDOUT with csv format, all rows are one chunk of progress."""
+        statement = self.__statement(sql)
+        conn = self.__connection(True)
+        cursor = None
+        try:
+            cursor = conn.cursor()
+            query = cursor.mogrify(statement.sql, tuple(args)).decode() if args else statement.sql
+            options = 'FORMAT csv, HEADER true' if header else 'FORMAT csv'
+            cursor.copy_expert(f'COPY ({query}) TO STDOUT WITH ({options})', file)
+            if progress is not None and cursor.rowcount > 0:
+                progress(cursor.rowcount)
+            return cursor.rowcount
+        finally:
+            if cursor is not None:
+                cursor.close()
+            self.__close_connection(conn)
+
+    def __group_rows(self, rows, table, generated_column=None):
+        """group rows by table and columns, returns list of (table, columns, input indexes, values).
+        :param generated_column: the column is left out of rows its value is None, so the database generates it
+        """
+        groups = {}
+        for index, data in enumerate(rows):
+            data_dict = self.__data2dict(data)
+            if generated_column is not None and data_dict.get(generated_column, 0) is None:
+                data_dict = {k: v for k, v in data_dict.items() if k != generated_column}
+            key = (table or type(data), tuple(data_dict.keys()))
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = (key[0], key[1], [], [])
+            group[2].append(index)
+            group[3].append(tuple(data_dict.values()))
+        return list(groups.values())
+
+    def __write_batches(self, operation, groups, batch_size, option=None):
+        """execute groups in batches, yields effective rows counts of every statement."""
+        for table_key, columns, indexes, values in groups:
+            rows_limit = self.__multi_rows_limit(len(columns)) if operation != 'UPDATE' else batch_size
+            for start in range(0, len(values), batch_size):
+                batch = values[start:start + batch_size]
+                with self._transaction_ctx:
+                    for i in range(0, len(batch), rows_limit):
+                        chunk = batch[i:i + rows_limit]
+                        if operation == 'UPDATE':
+                            statement = self.__multi_rows_statement(operation, table_key, columns, 1, option)
+                            yield self._execute(statement, chunk, batch=True)
+                        else:
+                            statement = self.__multi_rows_statement(operation, table_key, columns, len(chunk), option)
+                            yield self._execute(statement, [[v for row in chunk for v in row]], batch=True)
+
+    def __insert_batches_returning(self, table_key, columns, values, batch_size, id_column):
+        """insert values in batches, yields (offset, ids) of every statement."""
+        id_index = columns.index(id_column) if id_column in columns else None
+        returning = id_column if self._dbms == 'postgresql' and id_index is None else None
+        multi_rows = id_index is not None or self._dbms in ('postgresql', 'mysql')
+        rows_limit = self.__multi_rows_limit(len(columns)) if multi_rows else 1
+        for start in range(0, len(values), batch_size):
+            batch = values[start:start + batch_size]
+            with self._transaction_ctx:
+                for i in range(0, len(batch), rows_limit):
+                    chunk = batch[i:i + rows_limit]
+                    statement = self.__multi_rows_statement('INSERT', table_key, columns, len(chunk), returning)
+                    args = [v for row in chunk for v in row]
+                    if id_index is not None:
+                        self._execute(statement, [args], batch=True)
+                        ids = [row[id_index] for row in chunk]
+                    elif returning:
+                        rows = self._execute(statement, args, returning=True)
+                        ids = [row[0] if isinstance(row, (tuple, list)) else row[id_column] for row in rows]
+                    elif self._dbms == 'mysql':
+                        first_id = self._execute(statement, args)
+                        step = self.__auto_increment_step()
+                        ids = list(range(first_id, first_id + len(chunk) * step, step))
+                    else:
+                        ids = [self._execute(statement, args)]
+                    yield start + i, ids
+
+    def __auto_increment_step(self):
+        """returns mysql @@auto_increment_increment, the interval of ids generated by one insert."""
+        if self._auto_increment_step is None:
+            self._auto_increment_step = self._execute('SELECT @@auto_increment_increment', fetchone=True,
+                                                      row_type=tuple)[0]
+        return self._auto_increment_step
+
+    def __multi_rows_limit(self, columns_count):
+        """returns maximum rows of one multi-row VALUES statement bounded by driver parameters limit."""
+        max_parameters, max_rows = _MULTI_ROWS_LIMITS.get(self._dbms, (999, 1000))
+        return max(1, min(max_rows, max_parameters // max(1, columns_count)))
+
+    def __multi_rows_statement(self, operation, table, columns, rows_count, option=None):
+        key = (operation + '_MANY', table, columns, self._dbms, rows_count, option)
+        statement = self.statement_cache.get(key)
+        if statement is None:
+            table_name = self.__table_name(None, table)
+            if operation == 'UPDATE':
+                set_snippet = ', '.join(list(map(lambda k: k + '=' + self._placeholder, columns)))
+                sql = f'UPDATE {table_name} SET {set_snippet} WHERE {option} = {self._placeholder}'
+                return self.__compile(key, sql)
+            k_snippet = ', '.join(columns)
+            v_snippet = '(' + ', '.join([self._placeholder] * len(columns)) + ')'
+            v_snippet = ', '.join([v_snippet] * rows_count)
+            sql = f'INSERT INTO {table_name}({k_snippet}) VALUES{v_snippet}'
+            if operation == 'UPSERT':
+                sql = sql + self.__upsert_snippet(columns, *option)
+            elif option:
+                sql = sql + f' RETURNING {option}'
+            statement = self.__compile(key, sql)
+        return statement
+
+    def __upsert_snippet(self, columns, conflict_columns, update_columns):
+        if update_columns is None:
+            update_columns = [c for c in columns if c not in conflict_columns]
+        if self._dbms == 'mysql':
+            set_snippet = ', '.join([f'{c}=VALUES({c})' for c in update_columns or conflict_columns[:1]])
+            return f' ON DUPLICATE KEY UPDATE {set_snippet}'
+        conflict_snippet = ', '.join(conflict_columns)
+        if not update_columns:
+            return f' ON CONFLICT({conflict_snippet}) DO NOTHING'
+        set_snippet = ', '.join([f'{c}=excluded.{c}' for c in update_columns])
+        return f' ON CONFLICT({conflict_snippet}) DO UPDATE SET {set_snippet}'
+
+    def __select(self, table, filters, columns=None, order_by=None, limit=None, offset=None, seek=None):
+        """returns select statement and args of find, seek is the keyset values rows are after, see find_pages."""
+        shape, args = _filter_shape(filters)
+        columns = _column_names(columns) if columns else ()
+        order_by = _column_names(order_by) if order_by else ()
+        key = ('SELECT', table, shape, self._dbms, columns, order_by, limit is not None, offset is not None,
+               seek is not None)
+        statement = self.statement_cache.get(key)
+        if statement is None:
+            table_name = self.__table_name(None, table)
+            where = self.__build_where_snippet(shape, *([self.__seek_snippet(order_by)] if seek is not None else ()))
+            select = ', '.join(columns) or '*'
+            order = ', '.join(c.lstrip('-') + (' DESC' if c.startswith('-') else '') for c in order_by)
+            sql = self.__limit_sql(f'SELECT {select} FROM {table_name} {where}'.rstrip(), order, limit, offset)
+            statement = self.__compile(key, sql)
+        if seek is not None:
+            args.extend(v for i in range(len(seek)) for v in seek[:i + 1])
+        if self._dbms == 'sqlserver':
+            if offset is not None:
+                args.extend((offset, limit) if limit is not None else (offset,))
+            elif limit is not None:
+                args.insert(0, limit)
         else:
-            clazz = table if table else data_type
-            # Specific field： TABLE_NAME
-            if clazz is not None:
-                if hasattr(clazz, 'TABLE_NAME'):
-                    val = getattr(clazz, 'TABLE_NAME')
-                    if val:
-                        return val
-            # Class name
-            return self.__camel2snake(clazz.__name__)
+            if limit is not None:
+                args.append(limit)
+            if offset is not None:
+                args.append(offset)
+        return statement, args
+
+    def __limit_sql(self, sql, order, limit, offset):
+        """append order by and dialect limit clause, the limit and offset are placeholders in this order, except
+        sqlserver TOP (?) without offset is the first placeholder."""
+        p = self._placeholder
+        if self._dbms == 'sqlserver':
+            if offset is not None:
+                sql += ' ORDER BY ' + (order or '(SELECT NULL)') + f' OFFSET {p} ROWS'
+                return sql + (f' FETCH NEXT {p} ROWS ONLY' if limit is not None else '')
+            if limit is not None:
+                sql = f'SELECT TOP ({p}) ' + sql[len('SELECT '):]
+            return sql + (' ORDER BY ' + order if order else '')
+        if order:
+            sql += ' ORDER BY ' + order
+        if limit is not None:
+            sql += f' LIMIT {p}'
+        elif offset is not None and self._dbms in _UNLIMITED_ROWS:
+            sql += ' LIMIT ' + _UNLIMITED_ROWS[self._dbms]
+        if offset is not None:
+            sql += f' OFFSET {p}'
+        return sql
+
+    def __compile(self, key, sql):
+        """compile crud sql and put it into statement cache."""
+        statement = _SqlStatement(sql)
+        self.statement_cache.put(key, statement)
+        return statement
+
+    @staticmethod
+    def __table_name(data_type, table):
+        return _table_name(data_type, table)
 
     def __return_type(self, table, return_type):
         if return_type is not None:
-            return return_type if return_type != dict else None
+            return return_type
         elif type(table) != str:
             return table
         return None
 
-    def __data2dict(self, data):
-        # TODO
-        return data if type(data) == dict else vars(data)
+    @staticmethod
+    def __data2dict(data):
+        return _data2dict(data)
 
     @staticmethod
     def __filter_dict(data, includes=(), excludes=()):
@@ -316,52 +1389,1872 @@ class DB:
         else:
             return dict(data)
 
-    @staticmethod
-    def __create_object(row, return_class):
-        if row is None:
-            return None
-        obj = return_class()
-        for item in row.items():
-            setattr(obj, item[0], item[1])
-        return obj
 
-    __camel_pattern = re.compile(r'(?<!^)(?=[A-Z])')
+class Listener:
+    """The base of listeners receive DB events, register by DB.add_listener, override the interested methods."""
 
-    @staticmethod
-    def __camel2snake(name):
-        return DB.__camel_pattern.sub('_', name).lower()
+    def before_execute(self, statement, args):
+        """called before statement executes, statement.sql is the executed sql, statement.type is statement type."""
 
+    def after_execute(self, statement, args, elapsed, rows, error):
+        """called after statement executed or failed.
+        :param elapsed: seconds of executing and fetching
+        :param rows: number of fetched or effected rows, None if unknown
+        :param error: the exception raised, None if succeeded
+        """
 
-class _TransactionCtx(threading.local):
-    """the transaction context"""
+    def on_checkout(self, conn, elapsed):
+        """called when a connection is checked out from pool, elapsed is seconds blocked by the pool."""
 
-    def __init__(self):
-        self.transaction = False
-        self.conn = None
-        self.transactions = 0
+    def on_checkin(self, conn):
+        """called when a connection is returned to pool."""
 
-    def __enter__(self):
-        self.transaction = True
-        self.transactions = self.transactions + 1
-        return self
+    def on_begin(self):
+        """called when a transaction begins."""
 
-    def __exit__(self, exctype, excvalue, traceback):
-        self.transactions = self.transactions - 1
+    def on_commit(self):
+        """called when a transaction commits."""
+
+    def on_rollback(self):
+        """called when a transaction rollbacks."""
+
+
+class StatsListener(Listener):
+    """The built-in listener counts statements, connection checkouts and transactions,
+    with latency histograms per statement type and a slow query log."""
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, slow_query_threshold=None, slow_query_size=100):
+        """
+        :param slow_query_threshold: seconds, slower statements are logged and kept in snapshot
+        :param slow_query_size: maximum number of slow queries kept
+        """
+        self.slow_query_threshold = slow_query_threshold
+        self.__lock = threading.Lock()
+        self.__statements = {}
+        self.__checkouts = self.__new_timer()
+        self.__transactions = {'begin': 0, 'commit': 0, 'rollback': 0}
+        self.__slow_queries = collections.deque(maxlen=slow_query_size)
+
+    def after_execute(self, statement, args, elapsed, rows, error):
+        with self.__lock:
+            timer = self.__statements.get(statement.type)
+            if timer is None:
+                timer = self.__statements[statement.type] = self.__new_timer()
+                timer['errors'] = 0
+            self.__observe(timer, elapsed)
+            if error is not None:
+                timer['errors'] += 1
+        threshold = self.slow_query_threshold
+        if threshold is not None and elapsed >= threshold:
+            self.__slow_queries.append({'sql': statement.sql, 'elapsed': elapsed, 'rows': rows})
+            _logger.warning('slow query %.3fs: %s', elapsed, statement.sql)
+
+    def on_checkout(self, conn, elapsed):
+        with self.__lock:
+            self.__observe(self.__checkouts, elapsed)
+
+    def on_begin(self):
+        self.__count_transaction('begin')
+
+    def on_commit(self):
+        self.__count_transaction('commit')
+
+    def on_rollback(self):
+        self.__count_transaction('rollback')
+
+    def snapshot(self):
+        """returns the statistics dict: statements of every type, checkouts, transactions and slow queries,
+        histogram is list of (upper bound seconds, count)."""
+        with self.__lock:
+            statements = {str(k or 'OTHER'): self.__timer_snapshot(v) for k, v in self.__statements.items()}
+            return {
+                'statements': statements,
+                'checkouts': self.__timer_snapshot(self.__checkouts),
+                'transactions': dict(self.__transactions),
+                'slow_queries': list(self.__slow_queries),
+            }
+
+    def __count_transaction(self, key):
+        with self.__lock:
+            self.__transactions[key] += 1
+
+    def __new_timer(self):
+        return {'count': 0, 'total': 0.0, 'max': 0.0, 'histogram': [0] * (len(self.BUCKETS) + 1)}
+
+    def __observe(self, timer, elapsed):
+        timer['count'] += 1
+        timer['total'] += elapsed
+        if elapsed > timer['max']:
+            timer['max'] = elapsed
+        timer['histogram'][bisect.bisect_left(self.BUCKETS, elapsed)] += 1
+
+    def __timer_snapshot(self, timer):
+        snapshot = dict(timer)
+        snapshot['mean'] = timer['total'] / timer['count'] if timer['count'] else 0.0
+        snapshot['histogram'] = list(zip(self.BUCKETS + (float('inf'),), timer['histogram']))
+        return snapshot
+
+
+class Profiler(Listener):
+    """The listener profiles statements by normalized sql of literals stripped: calls, time and rows, captures
+    query plans of slow statements, and detects N+1 queries: the same single row select runs many times in a scope.
+    """
+
+    EXPLAINED_TYPES = ('SELECT', 'UPDATE', 'DELETE')
+
+    def __init__(self, db, sample_rate=1.0, explain_threshold=None, n_plus_one_threshold=10, contextual=False):
+        """
+        :param db: the DB runs EXPLAIN
+        :param sample_rate: fraction of statements recorded, statements in scope are all counted for N+1
+        :param explain_threshold: seconds, query plans of slower statements are captured once per normalized sql
+            after the connection is returned to pool (None means never)
+        :param n_plus_one_threshold: times a single row select runs in one scope to be reported as N+1
+        :param contextual: record statements run in scope only, see scope
+        """
+        self.db = db
+        self.sample_rate = sample_rate
+        self.explain_threshold = explain_threshold
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.__contextual = contextual
+        self.__lock = threading.Lock()
+        self.__statements = {}
+        self.__plans = {}
+        self.__n_plus_one = {}
+        self.__pending = collections.deque()
+        self.__scope = contextvars.ContextVar('dbtool_profile_%x' % id(self), default=None)
+        self.__explaining = contextvars.ContextVar('dbtool_explaining_%x' % id(self), default=False)
+
+    @contextlib.contextmanager
+    def scope(self):
+        """count single row selects run in the context, like a web request, the ones run n_plus_one_threshold times
+        or more are reported as N+1 when the scope exits."""
+        counts = collections.Counter()
+        token = self.__scope.set(counts)
         try:
-            if self.transactions == 0:
-                if exctype is None:
-                    self.conn.commit()
-                else:
-                    self.conn.rollback()
+            yield self
         finally:
-            if self.transactions == 0:
-                self.conn.close()
-                self.conn = None
+            self.__scope.reset(token)
+            with self.__lock:
+                for sql, count in counts.items():
+                    if count >= self.n_plus_one_threshold:
+                        finding = self.__n_plus_one.get(sql)
+                        if finding is None:
+                            finding = self.__n_plus_one[sql] = {'sql': sql, 'count': 0, 'scopes': 0, 'max': 0}
+                        finding['count'] += count
+                        finding['scopes'] += 1
+                        finding['max'] = max(finding['max'], count)
 
-    def init_conn_maybe(self, conn):
-        if self.transaction and self.conn is None:
-            self.conn = conn
-            self.conn.begin()
+    def after_execute(self, statement, args, elapsed, rows, error):
+        if self.__explaining.get():
+            return
+        counts = self.__scope.get()
+        if counts is None and self.__contextual:
+            return
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        if not sampled and counts is None:
+            return
+        sql = _normalize_sql(statement.sql)
+        if counts is not None and statement.is_select and rows is not None and 0 <= rows <= 1:
+            counts[sql] += 1
+        if not sampled:
+            return
+        with self.__lock:
+            entry = self.__statements.get(sql)
+            if entry is None:
+                entry = self.__statements[sql] = {'sql': sql, 'type': statement.type, 'count': 0, 'total': 0.0,
+                                                  'max': 0.0, 'rows': 0, 'errors': 0}
+            entry['count'] += 1
+            entry['total'] += elapsed
+            if elapsed > entry['max']:
+                entry['max'] = elapsed
+            if rows is not None and rows > 0:
+                # drivers report rowcount -1 of ddl and some selects
+                entry['rows'] += rows
+            if error is not None:
+                entry['errors'] += 1
+            threshold = self.explain_threshold
+            if threshold is not None and elapsed >= threshold and error is None and sql not in self.__plans and \
+                    statement.type in self.EXPLAINED_TYPES:
+                self.__plans[sql] = None
+                self.__pending.append((sql, statement, args))
+
+    def on_checkin(self, conn):
+        if self.__pending and not self.__explaining.get():
+            self.explain_pending()
+
+    def explain_pending(self):
+        """capture query plans of slow statements recorded, it runs when a connection is returned to pool."""
+        token = self.__explaining.set(True)
+        try:
+            while self.__pending:
+                try:
+                    sql, statement, args = self.__pending.popleft()
+                except IndexError:
+                    break
+                try:
+                    plan = [list(row) for row in self.db.explain(statement, args)]
+                except Exception as e:
+                    _logger.debug('explain failed: %s: %s', e, statement.sql)
+                    continue
+                with self.__lock:
+                    self.__plans[sql] = plan
+        finally:
+            self.__explaining.reset(token)
+
+    def report(self):
+        """returns the profile dict: statements sorted by total seconds with mean and query plan, and N+1 findings
+        sorted by count."""
+        with self.__lock:
+            statements = []
+            for sql, entry in self.__statements.items():
+                item = dict(entry)
+                item['mean'] = entry['total'] / entry['count']
+                item['plan'] = self.__plans.get(sql)
+                statements.append(item)
+            n_plus_one = [dict(finding) for finding in self.__n_plus_one.values()]
+        statements.sort(key=lambda item: item['total'], reverse=True)
+        n_plus_one.sort(key=lambda item: item['count'], reverse=True)
+        return {'sample_rate': self.sample_rate, 'statements': statements, 'n_plus_one': n_plus_one}
+
+    def to_json(self, file=None, indent=2):
+        """returns the report as json, also written to the file path or file object if given."""
+        text = json.dumps(self.report(), indent=indent, default=str)
+        if file is not None:
+            with _open_file(file, 'w') as f:
+                f.write(text)
+        return text
+
+    def reset(self):
+        with self.__lock:
+            self.__statements.clear()
+            self.__plans.clear()
+            self.__n_plus_one.clear()
+            self.__pending.clear()
+
+
+class CacheBackend:
+    """The storage of ResultCache, subclass it to share cached results, e.g. by redis or memcached.
+
+    Keys are tuples of (sql, args) and values are tuples of (columns, rows), both contain plain values only.
+    """
+    evictions = 0
+
+    def get(self, key):
+        """returns the cached value, None if missing or expired."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl, table):
+        """cache value of a query of table for ttl seconds, None means no expiration."""
+        raise NotImplementedError
+
+    def invalidate(self, tables):
+        """remove cached values of tables, None means all tables."""
+        raise NotImplementedError
+
+    def __len__(self):
+        return 0
+
+
+class MemoryCacheBackend(CacheBackend):
+    """The in process lru storage of ResultCache, maxsize None means unbounded"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self.__data = collections.OrderedDict()
+        self.__tables = collections.defaultdict(set)
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            item = self.__data.get(key)
+            if item is None:
+                return None
+            expires, table, value = item
+            if expires is not None and expires < time.monotonic():
+                self.__remove(key)
+                self.evictions += 1
+                return None
+            self.__data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl, table):
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self.__lock:
+            if key in self.__data:
+                self.__remove(key)
+            self.__data[key] = (expires, table, value)
+            self.__tables[table].add(key)
+            while self.maxsize is not None and len(self.__data) > self.maxsize:
+                self.__remove(next(iter(self.__data)))
+                self.evictions += 1
+
+    def invalidate(self, tables):
+        with self.__lock:
+            if tables is None:
+                self.__data.clear()
+                self.__tables.clear()
+                return
+            for table in tables:
+                for key in self.__tables.pop(table, ()):
+                    del self.__data[key]
+
+    def __remove(self, key):
+        table = self.__data.pop(key)[1]
+        keys = self.__tables[table]
+        keys.discard(key)
+        if not keys:
+            del self.__tables[table]
+
+    def __len__(self):
+        return len(self.__data)
+
+
+_CACHE_TTL = object()
+
+
+class ResultCache:
+    """The query results cache of DB, see DB.enable_result_cache"""
+
+    def __init__(self, ttl=60, maxsize=1024, backend=None, tables=None):
+        self.ttl = ttl
+        self.backend = backend if backend is not None else MemoryCacheBackend(maxsize)
+        self.tables = frozenset(table.lower() for table in tables) if tables is not None else None
+        self.hits = self.misses = self.invalidations = 0
+        self.__generation = 0  # invalidations of all tables
+        self.__generations = collections.Counter()  # table: invalidations of table
+        self.__lock = threading.Lock()
+
+    def cacheable(self, table):
+        return self.tables is None or table.lower() in self.tables
+
+    def generation(self, table):
+        """returns the invalidation generation of table, read it before the query of a value put later."""
+        return self.__generation, self.__generations[table.lower()]
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self.__lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, key, value, table, generation=None, ttl=_CACHE_TTL):
+        """cache value of a query of table, dropped if table is invalidated since the generation read before the
+        query, otherwise a result read before a concurrent write would be cached after its invalidation.
+        :param ttl: seconds the value is cached, default the ttl of cache
+        """
+        table = table.lower()
+        with self.__lock:
+            if generation is not None and generation != (self.__generation, self.__generations[table]):
+                return
+            self.backend.set(key, value, self.ttl if ttl is _CACHE_TTL else ttl, table)
+
+    def invalidate(self, tables=None):
+        """remove cached results of tables, None means all tables."""
+        if tables is not None:
+            tables = [table.lower() for table in tables]
+        with self.__lock:
+            if tables is None:
+                self.__generation += 1
+            else:
+                self.__generations.update(tables)
+            self.backend.invalidate(tables)
+            self.invalidations += 1
+
+    def info(self):
+        """returns cache statistics: hits, misses, evictions, invalidations, currsize."""
+        return _ResultCacheInfo(self.hits, self.misses, self.backend.evictions, self.invalidations, len(self.backend))
+
+
+class Session:
+    """The unit of work of DB: an identity map of loaded rows by (table, id), changes are written at commit.
+
+    Rows are dicts or entity objects. Attributes changed since load are tracked by snapshots and only dirty columns
+    are updated, rows of the same table and dirty columns are updated by one batched statement. Inserts, updates and
+    deletes of one commit run in one transaction. Use it in one thread, like a DB connection.
+    """
+
+    def __init__(self, db, id_column='id', batch_size=500):
+        """ Init Session.
+        :param db: the DB
+        :param id_column: the primary column name of tables
+        :param batch_size: maximum ids of one IN query and rows of one batch
+        """
+        self.db = db
+        self.id_column = id_column
+        self.batch_size = batch_size
+        self.__identity = {}  # (table name, id): row
+        self.__tables = {}  # (table name, id): table name or entity class
+        self.__snapshots = {}  # (table name, id): {column: value} at load or last commit
+        self.__new = []  # (table, row)
+        self.__deleted = {}  # (table name, id): table
+        self.__pending = {}  # table name: (table, return type, ids) loaded by the next ref get
+        self.__missing = set()  # (table name, id) not found
+
+    def get(self, table, id_value, return_type=None):
+        """returns the row of id from identity map, or find it, None if not found.
+        :param table: the table name or entity class
+        :param id_value: the primary column value
+        :param return_type: the return row type, default the entity class or dict
+        """
+        key = (_table_name(None, table), id_value)
+        if key not in self.__identity and key not in self.__missing:
+            self.__load(table, return_type, (id_value,))
+        return self.__identity.get(key)
+
+    def get_many(self, table, id_values, return_type=None):
+        """returns rows of ids in order, rows not in identity map are found by batched IN queries, None if not found.
+        """
+        id_values = list(id_values)
+        table_name = _table_name(None, table)
+        self.__load(table, return_type, [v for v in id_values if (table_name, v) not in self.__identity])
+        return [self.__identity.get((table_name, v)) for v in id_values]
+
+    def ref(self, table, id_value, return_type=None):
+        """returns the lazy reference of row, refs of a table not loaded yet are loaded together by one IN query
+        when the first of them is resolved, so loading refs in a loop costs one query rather than one each row.
+        """
+        table_name = _table_name(None, table)
+        if (table_name, id_value) not in self.__identity:
+            pending = self.__pending.get(table_name)
+            if pending is None:
+                pending = self.__pending[table_name] = (table, return_type, set())
+            pending[2].add(id_value)
+        return _Ref(self, table, id_value, return_type)
+
+    def find(self, table, filters={}, return_type=None, **options):
+        """find rows and put them into identity map, rows in identity map are returned instead of found ones,
+        see DB.find."""
+        return [self.__register(table, row) for row in self.db.find(table, filters, return_type, **options)]
+
+    def find_one(self, table, filters, return_type=None, **options):
+        """find one row and put it into identity map, see find and DB.find_one."""
+        row = self.db.find_one(table, filters, return_type, **options)
+        return self.__register(table, row) if row is not None else None
+
+    def add(self, data, table=None):
+        """add a new row inserted at commit, the generated id is set to the row after commit."""
+        self.__new.append((table or type(data), data))
+        return data
+
+    def delete(self, data, table=None):
+        """delete the row at commit."""
+        table = table or type(data)
+        key = (_table_name(None, table), _data2dict(data)[self.id_column])
+        self.__deleted[key] = table
+
+    def dirty(self, data, table=None):
+        """returns dict of {column: value} changed since load of row."""
+        data_dict = _data2dict(data)
+        key = (_table_name(type(data), table), data_dict[self.id_column])
+        snapshot = self.__snapshots.get(key, {})
+        return {c: v for c, v in data_dict.items() if c not in snapshot or snapshot[c] != v}
+
+    def commit(self):
+        """write new, dirty and deleted rows in one transaction, dirty rows of same columns are batched."""
+        inserts = collections.defaultdict(list)
+        for table, data in self.__new:
+            data_dict = dict(_data2dict(data))
+            if data_dict.get(self.id_column) is None:
+                data_dict.pop(self.id_column, None)
+            inserts[table].append((data, data_dict))
+        updates = collections.defaultdict(list)
+        for key, data in self.__identity.items():
+            if key in self.__deleted:
+                continue
+            changed = self.dirty(data, self.__tables[key])
+            if changed:
+                changed[self.id_column] = key[1]
+                updates[self.__tables[key]].append(changed)
+        deletes = collections.defaultdict(list)
+        for (table_name, id_value), table in self.__deleted.items():
+            deletes[table].append(id_value)
+        inserted = []
+        with self.db.transaction():
+            for table, items in inserts.items():
+                ids = self.db.insert_many([d for _, d in items], table, self.batch_size, True, self.id_column)
+                inserted.extend((table, data, data_dict, row_id) for (data, data_dict), row_id in zip(items, ids))
+            for table, rows in updates.items():
+                self.db.update_many(rows, table, self.id_column, self.batch_size)
+            for table, ids in deletes.items():
+                for i in range(0, len(ids), self.batch_size):
+                    self.db.delete(table, {self.id_column + '__in': ids[i:i + self.batch_size]})
+        for key in self.__deleted:
+            self.__forget(key)
+        for key, data in self.__identity.items():
+            self.__snapshots[key] = dict(_data2dict(data))
+        for table, data, data_dict, row_id in inserted:
+            if self.id_column not in data_dict and row_id is not None:
+                _set_id(data, self.id_column, row_id)
+            if _data2dict(data).get(self.id_column) is not None:
+                self.__register(table, data)
+        self.__new.clear()
+        self.__deleted.clear()
+
+    def rollback(self):
+        """discard new and deleted rows, changed rows keep their values and are still dirty, see clear."""
+        self.__new.clear()
+        self.__deleted.clear()
+
+    def clear(self):
+        """detach all rows and discard changes."""
+        self.rollback()
+        self.__identity.clear()
+        self.__tables.clear()
+        self.__snapshots.clear()
+        self.__pending.clear()
+        self.__missing.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        if exctype is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def _resolve(self, table, id_value, return_type):
+        key = (_table_name(None, table), id_value)
+        if key not in self.__identity and key not in self.__missing:
+            pending = self.__pending.pop(key[0], None)
+            ids = pending[2] if pending is not None else set()
+            ids.add(id_value)
+            self.__load(table, return_type, [v for v in ids if (key[0], v) not in self.__identity])
+        return self.__identity.get(key)
+
+    def __load(self, table, return_type, id_values):
+        table_name = _table_name(None, table)
+        id_values = list(dict.fromkeys(id_values))
+        for i in range(0, len(id_values), self.batch_size):
+            batch = id_values[i:i + self.batch_size]
+            if len(batch) == 1:
+                rows = self.db.find(table, {self.id_column: batch[0]}, return_type)
+            else:
+                rows = self.db.find(table, {self.id_column + '__in': batch}, return_type)
+            for row in rows:
+                self.__register(table, row)
+            self.__missing.update((table_name, v) for v in batch if (table_name, v) not in self.__identity)
+
+    def __register(self, table, row):
+        data_dict = _data2dict(row)
+        key = (_table_name(type(row), table), data_dict[self.id_column])
+        existing = self.__identity.get(key)
+        if existing is not None:
+            return existing
+        self.__identity[key] = row
+        self.__tables[key] = table
+        self.__snapshots[key] = dict(data_dict)
+        self.__missing.discard(key)
+        return row
+
+    def __forget(self, key):
+        self.__identity.pop(key, None)
+        self.__tables.pop(key, None)
+        self.__snapshots.pop(key, None)
+
+
+class _Ref:
+    """the lazy reference of a row of Session, see Session.ref"""
+
+    def __init__(self, session, table, id_value, return_type=None):
+        self.__session = session
+        self.__table = table
+        self.__return_type = return_type
+        self.id = id_value
+
+    def get(self):
+        """returns the referenced row, None if not found."""
+        return self.__session._resolve(self.__table, self.id, self.__return_type)
+
+
+def _set_id(data, id_column, id_value):
+    """set the generated id to dict or entity row."""
+    if type(data) is dict:
+        data[id_column] = id_value
+    elif not isinstance(data, tuple):
+        renames = getattr(type(data), 'COLUMN_MAP', None) or {}
+        setattr(data, renames.get(id_column, id_column), id_value)
+
+
+class Writer:
+    """The write-behind writer of DB: rows are queued and inserted by a background thread with insert_many,
+    one transaction each flush. A flush is triggered by batch_size queued rows, flush_interval seconds since the
+    first queued row, flush() or close(). Rows still queued are lost if the process exits without close.
+    """
+
+    def __init__(self, db, table=None, batch_size=1000, flush_interval=1.0, max_queue=10000, block=True,
+                 timeout=None, on_error=None):
+        """ Init Writer.
+        :param db: the DB
+        :param table: the default table name or entity class, default the entity class of row
+        :param batch_size: maximum rows of one flush
+        :param flush_interval: maximum seconds a row waits in queue (None means no time trigger)
+        :param max_queue: maximum number of queued rows, insert blocks or raises queue.Full when the queue is full
+        :param block: whether insert blocks when the queue is full
+        :param timeout: maximum seconds insert blocks, then raises queue.Full (None means forever)
+        :param on_error: function(error, rows) called when a flush fails, the failed rows are not retried,
+            default the error is logged to logger 'dbtool'
+        """
+        self.db = db
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = block
+        self.timeout = timeout
+        self.on_error = on_error
+        self.written = self.failed = self.flushes = self.errors = 0
+        self.flush_time = 0.0
+        self.__started = time.monotonic()
+        self.__closed = False
+        self.__queue = queue.Queue(max_queue)
+        self.__thread = threading.Thread(target=self.__run, name='dbtool-writer', daemon=True)
+        self.__thread.start()
+
+    def insert(self, data, table=None):
+        """queue a row inserted by the background thread."""
+        if self.__closed:
+            raise Exception('writer is closed')
+        self.__queue.put((table or self.table, data), self.block, self.timeout)
+
+    def flush(self, timeout=None):
+        """write queued rows now, returns whether they are written before timeout seconds."""
+        if self.__closed:
+            return True
+        done = threading.Event()
+        self.__queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=None):
+        """write queued rows and stop the background thread, further inserts raise exception."""
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__queue.put(_WRITER_STOP)
+        self.__thread.join(timeout)
+
+    def metrics(self):
+        """returns counters: queued, written, failed rows, flushes, errors, flush seconds and written rows per second.
+        """
+        elapsed = time.monotonic() - self.__started
+        return {
+            'queued': self.__queue.qsize(),
+            'written': self.written,
+            'failed': self.failed,
+            'flushes': self.flushes,
+            'errors': self.errors,
+            'flush_time': self.flush_time,
+            'rows_per_second': self.written / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        self.close()
+
+    def __run(self):
+        buffer, deadline = [], None
+        while True:
+            timeout = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+            try:
+                item = self.__queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if type(item) is tuple:
+                buffer.append(item)
+                if deadline is None and self.flush_interval is not None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(buffer) < self.batch_size:
+                    continue
+            if buffer:
+                self.__write(buffer)
+                buffer, deadline = [], None
+            if item is _WRITER_STOP:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+
+    def __write(self, buffer):
+        groups = collections.defaultdict(list)
+        for table, data in buffer:
+            groups[table].append(data)
+        start = time.perf_counter()
+        try:
+            with self.db.transaction():
+                for table, rows in groups.items():
+                    self.db.insert_many(rows, table, self.batch_size)
+        except Exception as e:
+            self.errors += 1
+            self.failed += len(buffer)
+            rows = [data for _, data in buffer]
+            if self.on_error is None:
+                _logger.exception('write-behind flush of %d rows failed', len(rows))
+            else:
+                try:
+                    self.on_error(e, rows)
+                except Exception:
+                    _logger.exception('write-behind on_error failed')
+        else:
+            self.written += len(buffer)
+            self.flushes += 1
+        finally:
+            self.flush_time += time.perf_counter() - start
+
+
+_WRITER_STOP = object()
+
+
+class ShardedDB:
+    """The facade of N sharded databases, each shard is a DB.
+
+    Calls with the shard key in data or filters are routed to one shard, others are scattered to all shards
+    on a thread pool and gathered: rows are concatenated in shard order or sorted by order_by, counts are summed.
+    """
+
+    def __init__(self, urls, shard_key, shard_func=None, max_workers=None, **options):
+        """ Init ShardedDB.
+        :param urls: urls of shards
+        :param shard_key: the column name decides the shard
+        :param shard_func: function(value, shards count) returns shard index, default modulo of int or crc32
+        :param max_workers: threads of scatter queries, default shards count
+        :param options: parameters of every DB, see DB
+        """
+        self.shards = [DB(url, **options) for url in urls]
+        self.shard_key = shard_key
+        self._shard_func = shard_func or _default_shard_func
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers or len(urls),
+                                                               thread_name_prefix='dbtool-shard')
+
+    def shard_for(self, value):
+        """returns the shard DB of shard key value."""
+        return self.shards[self._shard_func(value, len(self.shards))]
+
+    def insert(self, data, table=None):
+        """insert one row to the shard of shard key, see DB.insert."""
+        data_dict = _data2dict(data)
+        if self.shard_key not in data_dict:
+            raise Exception('shard key is required:' + self.shard_key)
+        return self.shard_for(data_dict[self.shard_key]).insert(data, table)
+
+    def update(self, data, table=None, id_column='id'):
+        """update one row, on all shards if no shard key, see DB.update."""
+        data_dict = _data2dict(data)
+        if self.shard_key in data_dict:
+            return self.shard_for(data_dict[self.shard_key]).update(data, table, id_column)
+        return sum(self.__scatter(lambda db: db.update(data, table, id_column)))
+
+    def delete(self, table, filters):
+        """delete rows, on all shards if no shard key, see DB.delete."""
+        if self.shard_key in filters:
+            return self.shard_for(filters[self.shard_key]).delete(table, filters)
+        return sum(self.__scatter(lambda db: db.delete(table, filters)))
+
+    def find(self, table, filters={}, return_type=None, columns=None, order_by=None, limit=None, offset=None):
+        """find rows, from all shards if no shard key, see DB.find.
+        :param order_by: column names sort rows, shards sort their rows and the sorted rows are merged
+        :param limit: maximum number of rows, shards return limit + offset rows at most
+        """
+        if self.shard_key in filters:
+            db = self.shard_for(filters[self.shard_key])
+            return db.find(table, filters, return_type, columns, order_by, limit, offset)
+        order_by = _column_names(order_by)
+        shard_limit = limit + (offset or 0) if limit is not None else None
+        results = self.__scatter(lambda db: db.find(table, filters, return_type, columns, order_by, shard_limit))
+        if order_by:
+            rows = _merge_rows(results, order_by)
+        else:
+            rows = [row for rows in results for row in rows]
+        if offset or limit is not None:
+            rows = rows[offset or 0:shard_limit]
+        return rows
+
+    def find_one(self, table, filters, return_type=None, columns=None, order_by=None):
+        """find one row, the first found of shards if no shard key, see DB.find_one.
+        :param order_by: column names sort rows, the first of the rows found by shards in order
+        """
+        if self.shard_key in filters:
+            return self.shard_for(filters[self.shard_key]).find_one(table, filters, return_type, columns, order_by)
+        order_by = _column_names(order_by)
+        rows = self.__scatter(lambda db: db.find_one(table, filters, return_type, columns, order_by))
+        rows = [row for row in rows if row is not None]
+        if order_by and rows:
+            rows = _sort_rows(rows, order_by)
+        return rows[0] if rows else None
+
+    def find_count(self, filters={}, table=None, **options):
+        """count rows, sum of all shards if no shard key, see DB.find_count."""
+        if self.shard_key in filters:
+            return self.shard_for(filters[self.shard_key]).find_count(filters, table, **options)
+        return _sum_counts(self.__scatter(lambda db: db.find_count(filters, table, **options)))
+
+    def __scatter(self, func):
+        """run func on all shards concurrently, returns results in shard order."""
+        return list(self._executor.map(func, self.shards))
+
+    def close(self):
+        """shutdown the scatter thread pool and close the shards, see DB.close."""
+        self._executor.shutdown(wait=False)
+        for db in self.shards:
+            db.close()
+
+
+def _default_shard_func(value, shards):
+    if isinstance(value, int):
+        return value % shards
+    return zlib.crc32(str(value).encode('utf-8')) % shards
+
+
+class AsyncDB:
+    """The asyncio front-end of DB, blocking calls run on a dedicated executor sized to maxconnections.
+
+    Transactions follow the asyncio task opens them, like DB transactions follow the thread.
+    """
+
+    def __init__(self, url, maxconnections=0, executor=None, **options):
+        """ Init AsyncDB, parameters see DB.
+        :param maxconnections: maximum number of connections, also the number of executor threads and the
+            number of calls, transactions and open iterators run concurrently, others wait (0 or None means the
+            executor default)
+        :param executor: the executor runs blocking calls, default a dedicated thread pool
+        """
+        self.db = DB(url, maxconnections=maxconnections, **options)
+        workers = maxconnections or min(32, (os.cpu_count() or 1) + 4)
+        self._executor = executor or concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='dbtool')
+        self._workers = workers
+        self._semaphore = None
+
+    async def _run(self, func, *args, **kwargs):
+        """run blocking func on executor in a copy of current context, so the task transaction is visible."""
+        return await self.__run(True, func, *args, **kwargs)
+
+    async def __run(self, slot, func, *args, **kwargs):
+        """run blocking func on executor, holds a slot meanwhile if slot, False if the caller holds one."""
+        context = contextvars.copy_context()
+        state = self.db._transaction_ctx.state
+        call = functools.partial(context.run, func, *args, **kwargs)
+        if state is not None:
+            if state.owner is asyncio.current_task():
+                # the task transaction holds a slot since it began
+                slot = False
+            else:
+                context.run(self.db._transaction_ctx.reset)
+        if not slot:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        async with self._slots():
+            return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    def _slots(self):
+        """returns the semaphore limits calls and transactions hold connections concurrently."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._workers)
+        return self._semaphore
+
+    def transaction(self, func=None, retry=0, backoff=0.05, max_backoff=2.0):
+        """returns async transaction context, or decorate coroutine function run in transaction, see DB.transaction."""
+        if func is None:
+            if retry:
+                return lambda f: self.transaction(f, retry, backoff, max_backoff)
+            return _AsyncTransactionCtx(self)
+        if not retry:
+            @functools.wraps(func)
+            async def wrapper(*args, **kw):
+                async with _AsyncTransactionCtx(self):
+                    return await func(*args, **kw)
+
+            return wrapper
+
+        @functools.wraps(func)
+        async def retry_wrapper(*args, **kw):
+            for attempt in itertools.count():
+                outermost = self.db._transaction_ctx.state is None
+                try:
+                    async with _AsyncTransactionCtx(self):
+                        result = await func(*args, **kw)
+                except Exception as e:
+                    delay = self.db._retry_delay(e, attempt, retry, backoff, max_backoff) if outermost else None
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                else:
+                    if attempt:
+                        self.db._count_retry('recovered')
+                    return result
+
+        return retry_wrapper
+
+    async def execute_iter(self, sql, args=(), chunk_size=1000, row_type=None):
+        """execute query sql, returns async iterator of rows, see DB.execute_iter."""
+        async for row in self.__iter(self.db._execute_chunks(sql, args, chunk_size, row_type=row_type)):
+            yield row
+
+    async def find_iter(self, table, filters={}, return_type=None, chunk_size=1000, **options):
+        """find rows by query, returns async iterator of rows, see DB.find_iter."""
+        async for row in self.__iter(self.db._find_chunks(table, filters, return_type, chunk_size, **options)):
+            yield row
+
+    async def find_pages(self, table, filters={}, order_by='id', page_size=100, return_type=None, columns=None):
+        """find rows by keyset pagination, returns async iterator of rows list, see DB.find_pages."""
+        pages = self.db.find_pages(table, filters, order_by, page_size, return_type, columns)
+        while True:
+            rows = await self._run(next, pages, None)
+            if rows is None:
+                break
+            yield rows
+
+    async def __iter(self, chunks):
+        """yield rows of chunks, the connection of chunks is checked out between chunks, so the iterator holds a
+        slot from the first chunk until it is exhausted, closed or collected."""
+        state = self.db._transaction_ctx.state
+        slots = None if state is not None and state.owner is asyncio.current_task() else self._slots()
+        if slots is not None:
+            await slots.acquire()
+        try:
+            while True:
+                rows = await self.__run(False, next, chunks, None)
+                if rows is None:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            try:
+                await self.__run(False, chunks.close)
+            finally:
+                if slots is not None:
+                    slots.release()
+
+    async def close(self):
+        """shutdown the executor and close idle connections of the pools."""
+        self._executor.shutdown(wait=False)
+        self.db.close()
+
+
+def _async_method(name):
+    method = getattr(DB, name)
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        return await self._run(getattr(self.db, name), *args, **kwargs)
+
+    return wrapper
+
+
+for _name in ('execute', 'execute_fetchone', 'execute_cursor', 'execute_batch', 'execute_script', 'close_cursor',
+              'execute_columns', 'insert', 'update', 'delete', 'find', 'find_one', 'find_count',
+              'insert_many', 'update_many', 'upsert_many', 'import_rows', 'export_query', 'explain'):
+    setattr(AsyncDB, _name, _async_method(_name))
+
+
+class _AsyncTransactionCtx:
+    """the async transaction context binds transaction to current asyncio task"""
+
+    def __init__(self, async_db):
+        self.__async_db = async_db
+        self.__ctx = async_db.db._transaction_ctx
+        self.__slot = False
+
+    async def __aenter__(self):
+        state = self.__ctx.state
+        if state is not None and state.owner is not asyncio.current_task():
+            self.__ctx.reset()
+            state = None
+        if state is None:
+            # the outermost transaction holds a slot until it ends, as its connection is checked out meanwhile
+            await self.__async_db._slots().acquire()
+            self.__slot = True
+        nested = self.__ctx.enter()
+        self.__ctx.state.owner = asyncio.current_task()
+        if nested:
+            await self.__async_db._run(self.__ctx.savepoint)
+        return self
+
+    async def __aexit__(self, exctype, excvalue, traceback):
+        try:
+            await self.__async_db._run(self.__ctx.__exit__, exctype, excvalue, traceback)
+        finally:
+            if self.__ctx.state is None:
+                self.__ctx.reset()
+            if self.__slot:
+                self.__slot = False
+                self.__async_db._slots().release()
+
+
+class _TransactionCtx:
+    """the transaction context of current thread or asyncio task, the state is kept in a context variable"""
+
+    def __init__(self, db=None):
+        self.__db = db
+        self.__state = contextvars.ContextVar('dbtool_transaction_%x' % id(self), default=None)
+
+    @property
+    def state(self):
+        """returns the active transaction state, None if not in transaction."""
+        state = self.__state.get()
+        return state if state is not None and state.transactions > 0 else None
+
+    @property
+    def conn(self):
+        state = self.__state.get()
+        return state.conn if state is not None else None
+
+    def reset(self):
+        """detach the transaction state from current context."""
+        self.__state.set(None)
+
+    def __enter__(self):
+        if self.enter():
+            self.savepoint()
+        return self
+
+    def enter(self):
+        """enter a transaction level without any statement, returns True if nested in an outer level."""
+        state = self.state
+        nested = state is not None
+        if not nested:
+            state = _TransactionState()
+            self.__state.set(state)
+        state.transaction = True
+        state.transactions = state.transactions + 1
+        return nested
+
+    def savepoint(self):
+        """create the savepoint of the innermost level, leave the level if failed."""
+        if self.__db is None:
+            return
+        state = self.state
+        name = 'dbtool_sp_%d' % (state.transactions - 1)
+        try:
+            self.__db._savepoint('create', name)
+        except BaseException:
+            state.transactions = state.transactions - 1
+            raise
+        state.savepoints.append(name)
+
+    def __exit__(self, exctype, excvalue, traceback):
+        state = self.__state.get()
+        state.transactions = state.transactions - 1
+        if state.transactions > 0:
+            if state.savepoints:
+                self.__db._savepoint('release' if exctype is None else 'rollback', state.savepoints.pop())
+            return
+        state.transaction = False
+        self.__state.set(None)
+        if state.conn is None:
+            return
+        try:
+            if exctype is None:
+                state.conn.commit()
+                if state.tables:
+                    self.__db._invalidate_results(None if None in state.tables else state.tables)
+                self.__notify('on_commit')
+            else:
+                state.conn.rollback()
+                self.__notify('on_rollback')
+        finally:
+            state.conn.close()
+            self.__notify('on_checkin', state.conn)
+            state.conn = None
+
+    def init_conn_maybe(self, conn):
+        state = self.state
+        if state is not None and state.transaction and state.conn is None:
+            state.conn = conn
+            if self.__db is not None:
+                self.__db._begin(conn)
+            else:
+                conn.begin()
+            self.__notify('on_begin')
+
+    def __notify(self, event, *args):
+        if self.__db is not None and self.__db._listeners:
+            self.__db._notify(event, *args)
+
+
+class _TransactionState:
+    """the transaction state shared by the thread or asyncio task runs the transaction"""
+
+    def __init__(self):
+        self.transaction = False
+        self.conn = None
+        self.transactions = 0
+        self.owner = None
+        self.tables = set()
+        self.savepoints = []
+
+
+def _steady_connection(conn):
+    """returns the dbutils steady connection of pooled or thread local connection, its _con is the driver one."""
+    return conn._con if type(conn) is PooledDedicatedDBConnection else conn
+
+
+class _Pool(PooledDB):
+    """PooledDB manages the connection lifecycle: max lifetime, idle timeout, background reaping, warm-up and
+    reset in a forked child process"""
+
+    def __init__(self, creator, mincached=0, max_lifetime=None, idle_timeout=None, reap_interval=None, **kwargs):
+        self._mincached = mincached or 0
+        self._max_lifetime = max_lifetime
+        self._idle_timeout = idle_timeout
+        self._expires = bool(max_lifetime or idle_timeout)
+        self._pid = os.getpid()
+        self._waiting = 0
+        self._created = 0
+        self._reaped = 0
+        self._inherited = []
+        self._refill = False
+        limits = [t for t in (max_lifetime, idle_timeout) if t]
+        self._reap_interval = reap_interval or (min(limits) / 2 if limits else None)
+        self._stop = None
+        super().__init__(creator, mincached=mincached, **kwargs)
+        self.__start_reaper()
+
+    def steady_connection(self):
+        con = super().steady_connection()
+        con._dbtool_created = con._dbtool_used = time.monotonic()
+        con._dbtool_pid = self._pid
+        with self._lock:
+            self._created += 1
+        return con
+
+    def connection(self, shareable=True):
+        if self._pid != os.getpid():
+            self.__reset_after_fork()
+        if self._expires and self._idle_cache:
+            with self._lock:
+                now = time.monotonic()
+                while self._idle_cache and self.__expired(self._idle_cache[0], now):
+                    self.__discard(self._idle_cache.pop(0))
+        if self._refill:
+            self._refill = False
+            self.warm_up(self._mincached)
+        return super().connection(shareable)
+
+    def cache(self, con):
+        if con._dbtool_pid != self._pid:
+            self._inherited.append(con)  # checked out before fork, owned by the parent process
+            return
+        now = time.monotonic()
+        if self._max_lifetime and now - con._dbtool_created > self._max_lifetime:
+            with self._lock:
+                self.__discard(con)
+                self._connections -= 1
+                self._lock.notify()
+            return
+        con._dbtool_used = now
+        super().cache(con)
+
+    def _wait_lock(self):
+        self._waiting += 1
+        try:
+            super()._wait_lock()
+        finally:
+            self._waiting -= 1
+
+    def warm_up(self, connections):
+        """open idle connections until there are connections idle ones, returns the number opened."""
+        if self._pid != os.getpid():
+            self.__reset_after_fork()
+        with self._lock:
+            missing = connections - len(self._idle_cache)
+            if self._maxconnections:
+                missing = min(missing, self._maxconnections - self._connections - len(self._idle_cache))
+        opened = []
+        try:
+            for _ in range(missing):
+                opened.append(self.steady_connection())
+        finally:
+            with self._lock:
+                self._idle_cache.extend(opened)
+        return len(opened)
+
+    def reap(self):
+        """close idle connections beyond max lifetime or idle timeout, the next checkout refills to mincached, so
+        connections are always opened by the threads use them."""
+        with self._lock:
+            now = time.monotonic()
+            expired = [con for con in self._idle_cache if self.__expired(con, now)]
+            if expired:
+                self._idle_cache[:] = [con for con in self._idle_cache if con not in expired]
+                self._refill = bool(self._mincached)
+            for con in expired:
+                self.__discard(con)
+        return len(expired)
+
+    def status(self):
+        with self._lock:
+            return {'in_use': self._connections, 'idle': len(self._idle_cache), 'waiting': self._waiting,
+                    'max': self._maxconnections or None, 'created': self._created, 'reaped': self._reaped}
+
+    def close(self):
+        if self._stop is not None:
+            self._stop.set()
+        super().close()
+
+    def __expired(self, con, now):
+        return (self._max_lifetime and now - con._dbtool_created > self._max_lifetime) or \
+            (self._idle_timeout and now - con._dbtool_used > self._idle_timeout)
+
+    def __discard(self, con):
+        con._close()
+        self._reaped += 1
+
+    def __start_reaper(self):
+        if self._reap_interval:
+            self._stop = threading.Event()
+            thread = threading.Thread(target=_reap_pool, args=(weakref.ref(self), self._stop, self._reap_interval),
+                                      name='dbtool-reaper', daemon=True)
+            thread.start()
+
+    def __reset_after_fork(self):
+        """forget connections inherited from the parent process, they share sockets with the parent, so they are
+        kept referenced and never closed in this process."""
+        self._inherited.extend(self._idle_cache)
+        self._idle_cache = []
+        self._lock = threading.Condition()
+        self._connections = 0
+        self._waiting = 0
+        self._pid = os.getpid()
+        self.__start_reaper()
+
+
+class _PersistentPool(PersistentDB):
+    """PersistentDB manages the lifecycle of thread local connections: a connection beyond max lifetime or unused
+    longer than idle timeout is reopened at the next use, and all are reset in a forked child process"""
+
+    def __init__(self, creator, max_lifetime=None, idle_timeout=None, **kwargs):
+        self._max_lifetime = max_lifetime
+        self._idle_timeout = idle_timeout
+        self._pid = os.getpid()
+        self._created = 0
+        self._reaped = 0
+        self._inherited = []
+        self._open = weakref.WeakSet()
+        self._lock = threading.Lock()
+        super().__init__(creator, **kwargs)
+
+    def steady_connection(self):
+        con = super().steady_connection()
+        con._dbtool_created = con._dbtool_used = time.monotonic()
+        with self._lock:
+            self._created += 1
+            self._open.add(con)
+        return con
+
+    def connection(self, shareable=False):
+        if self._pid != os.getpid():
+            self._inherited.append(self.thread)
+            self.thread = threading.local()
+            self._open = weakref.WeakSet()
+            self._pid = os.getpid()
+        con = super().connection()
+        now = time.monotonic()
+        if (self._max_lifetime or self._idle_timeout) and not con._transaction and \
+                ((self._max_lifetime and now - con._dbtool_created > self._max_lifetime) or
+                 (self._idle_timeout and now - con._dbtool_used > self._idle_timeout)):
+            con._close()
+            con._store(con._create())
+            con._dbtool_created = now
+            self._reaped += 1
+        con._dbtool_used = now
+        return con
+
+    def warm_up(self, connections):
+        """open the connection of current thread, returns the number opened."""
+        created = self._created
+        self.connection()
+        return self._created - created
+
+    def reap(self):
+        return 0
+
+    def status(self):
+        with self._lock:
+            in_use = sum(1 for con in self._open if not con._closed)
+        return {'in_use': in_use, 'idle': 0, 'waiting': 0, 'max': None, 'created': self._created,
+                'reaped': self._reaped}
+
+    def close(self):
+        """thread local connections are closed with their threads."""
+
+
+def _reap_pool(pool_ref, stop, interval):
+    """reap idle connections of the pool every interval seconds until the pool is closed or garbage collected."""
+    while not stop.wait(interval):
+        pool = pool_ref()
+        if pool is None:
+            return
+        try:
+            pool.reap()
+        except Exception:
+            _logger.exception('reap pool connections failed')
+        del pool
+
+
+_SAVEPOINT_SQL = {
+    None: {
+        'create': ('SAVEPOINT %s',),
+        'release': ('RELEASE SAVEPOINT %s',),
+        'rollback': ('ROLLBACK TO SAVEPOINT %s', 'RELEASE SAVEPOINT %s'),
+    },
+    'sqlserver': {
+        'create': ('SAVE TRANSACTION %s',),
+        'release': (),
+        'rollback': ('ROLLBACK TRANSACTION %s',),
+    },
+}
+
+_TRANSIENT_ERRORS = {
+    'mysql': (1205, 1213),  # lock wait timeout, deadlock
+    'postgresql': ('40001', '40P01'),  # serialization failure, deadlock detected
+    'sqlserver': (1205,),  # deadlock victim
+}
+
+
+def _is_transient_error(dbms, error):
+    """returns True if error is transient and the transaction may succeed when re-run."""
+    if dbms == 'sqlite':
+        if type(error).__name__ != 'OperationalError':
+            return False
+        code = getattr(error, 'sqlite_errorcode', None)
+        if code is not None:
+            return code & 0xff in (5, 6)  # SQLITE_BUSY, SQLITE_LOCKED
+        message = str(error)
+        return 'locked' in message or 'busy' in message
+    if dbms == 'postgresql':
+        return getattr(error, 'pgcode', None) in _TRANSIENT_ERRORS[dbms]
+    args = getattr(error, 'args', ())
+    return bool(args) and args[0] in _TRANSIENT_ERRORS.get(dbms, ())
+
+
+def _numbered_placeholders(sql):
+    """returns sql of psycopg2 %s placeholders as $1, $2 ... and %% as %, psycopg2 interpolates the whole sql."""
+    counter = itertools.count(1)
+    return re.sub(r'%[s%]', lambda m: '%' if m.group(0) == '%%' else '$%d' % next(counter), sql)
+
+
+def _placeholder_pattern(dbms):
+    """returns the pattern tokenize sql into quoted strings, comments and ? placeholder."""
+    tokens = [
+        r"--[^\n]*",  # line comment
+        r"/\*.*?\*/",  # block comment
+    ]
+    if dbms == 'mysql':
+        # double quoted string unless ANSI_QUOTES, backslash escapes in both quoted strings
+        tokens += [r'"[^"\\]*(?:(?:\\.|"")[^"\\]*)*"', r"'[^'\\]*(?:(?:\\.|'')[^'\\]*)*'", r"`[^`]*(?:``[^`]*)*`",
+                   r"#[^\n]*"]
+    else:
+        tokens += [r'"[^"]*(?:""[^"]*)*"',  # quoted identifier
+                   r"(?<!\w)[eE]'[^'\\]*(?:(?:\\.|'')[^'\\]*)*'", r"'[^']*(?:''[^']*)*'"]
+    if dbms == 'postgresql':
+        tokens += [r"\$(\w*)\$.*?\$\1\$", r"\?(?:\|(?!\|)|&)"]  # dollar quoted string, jsonb ?| ?& operator
+    if dbms == 'sqlserver':
+        tokens += [r"\[[^\]]*\]"]
+    tokens += [r"\?"]
+    return re.compile('|'.join(tokens), re.DOTALL)
+
+
+def _replace_placeholder(sql, placeholder, pattern):
+    """replace ? placeholder of sql in one pass, the pattern see _placeholder_pattern."""
+    if '?' not in sql:
+        return sql
+    return pattern.sub(lambda m: placeholder if m.group(0) == '?' else m.group(0), sql)
+
+
+def _row_mapper(row_type, description):
+    """returns the cached mapper converts tuple row of cursor description to row type, None if tuple row is used as it.
+    Entity class supports plain class, __slots__ class, dataclass and namedtuple, columns are renamed to attributes by
+    class attribute COLUMN_MAP: {column: attribute}."""
+    if row_type is None or row_type is tuple or _is_sqlite_row(row_type):
+        return None
+    if isinstance(row_type, type) and issubclass(row_type, Row):
+        row_type = Row
+    columns = tuple(column[0] for column in description)
+    key = (row_type, columns)
+    mapper = _mapper_cache.get(key)
+    if mapper is None:
+        if row_type is dict:
+            mapper = functools.partial(_dict_row, columns)
+        elif row_type is Row:
+            mapper = _row_class(columns)
+        else:
+            mapper = _compile_mapper(row_type, columns)
+        _mapper_cache.put(key, mapper)
+    return mapper
+
+
+def _dict_row(columns, row):
+    return dict(zip(columns, row))
+
+
+def _is_sqlite_row(row_type):
+    return getattr(row_type, '__module__', None) == 'sqlite3' and getattr(row_type, '__name__', None) == 'Row'
+
+
+def _compile_mapper(cls, columns):
+    renames = getattr(cls, 'COLUMN_MAP', None) or {}
+    attributes = [renames.get(column, column) for column in columns]
+    init_fields, frozen = None, False
+    if issubclass(cls, tuple) and hasattr(cls, '_fields'):
+        init_fields = set(cls._fields)
+        frozen = True
+    elif hasattr(cls, '__dataclass_fields__'):
+        dataclasses = importlib.import_module('dataclasses')
+        init_fields = {f.name for f in dataclasses.fields(cls) if f.init}
+        frozen = cls.__dataclass_params__.frozen
+    lines = []
+    if init_fields is not None:
+        init_args = ', '.join(f'{attr}=row[{i}]' for i, attr in enumerate(attributes) if attr in init_fields)
+        lines.append(f'obj = cls({init_args})')
+    else:
+        lines.append('obj = cls()')
+    setters = [(i, attr) for i, attr in enumerate(attributes) if init_fields is None or attr not in init_fields]
+    if setters and not frozen:
+        slots = set(_slots(cls))
+        has_dict = _has_instance_dict(cls)
+        custom_setattr = cls.__setattr__ is not object.__setattr__
+        for i, attr in setters:
+            if custom_setattr or attr in slots or isinstance(getattr(cls, attr, None), property):
+                lines.append(f'setattr(obj, {attr!r}, row[{i}])')
+            elif has_dict:
+                lines.append(f'obj.__dict__[{attr!r}] = row[{i}]')
+    source = 'def mapper(row):\n' + ''.join(f'    {line}\n' for line in lines) + '    return obj\n'
+    namespace = {'cls': cls}
+    exec(source, namespace)
+    return namespace['mapper']
+
+
+def _has_instance_dict(cls):
+    return any('__dict__' in vars(klass) for klass in cls.__mro__[:-1])
+
+
+def _slots(cls):
+    for klass in cls.__mro__:
+        slots = vars(klass).get('__slots__', ())
+        for name in ((slots,) if isinstance(slots, str) else slots):
+            if name not in ('__dict__', '__weakref__'):
+                yield name
+
+
+def _table_name(data_type, table):
+    if type(table) is str:
+        return table
+    else:
+        clazz = table if table else data_type
+        # Specific field： TABLE_NAME
+        if clazz is not None:
+            if hasattr(clazz, 'TABLE_NAME'):
+                val = getattr(clazz, 'TABLE_NAME')
+                if val:
+                    return val
+        # Class name
+        return _camel_pattern.sub('_', clazz.__name__).lower()
+
+
+_camel_pattern = re.compile(r'(?<!^)(?=[A-Z])')
+
+
+def _data2dict(data):
+    return data if type(data) == dict else _entity_dumper(type(data))(data)
+
+
+def _row_value(row, column):
+    """returns column value of dict, Row or entity row."""
+    return row[column] if isinstance(row, (dict, Row)) or _is_sqlite_row(type(row)) else getattr(row, column)
+
+
+def _sort_rows(rows, order_by):
+    """sort rows by columns in place, column prefix - means descending."""
+    for column in reversed(order_by):
+        descending = column.startswith('-')
+        column = column.lstrip('-')
+        rows.sort(key=lambda row: _row_value(row, column), reverse=descending)
+    return rows
+
+
+def _merge_rows(results, order_by):
+    """merge rows lists sorted by order_by into one sorted list, see _sort_rows."""
+    descending = {column.startswith('-') for column in order_by}
+    if len(descending) > 1:
+        return _sort_rows([row for rows in results for row in rows], order_by)
+    columns = [column.lstrip('-') for column in order_by]
+    key = (lambda row: tuple(_row_value(row, column) for column in columns))
+    return list(heapq.merge(*results, key=key, reverse=descending.pop()))
+
+
+def _written_tables(sql):
+    """returns the table names written by insert, replace, update or delete sql, None if unknown."""
+    match = _written_table_pattern.match(sql)
+    if match is None:
+        return None
+    name = next(group for group in match.groups() if group)
+    return (re.split(r'[.]', name)[-1].strip('"`[]'),)
+
+
+@functools.lru_cache(maxsize=1024)
+def _normalize_sql(sql):
+    """returns sql of literals and placeholders as ?, lists of them as (...) and repeated groups as one."""
+    sql = _literal_pattern.sub('?', ' '.join(sql.split()))
+    sql = _in_list_pattern.sub('(...)', sql)
+    return _repeated_group_pattern.sub(r'\1, ...', sql)
+
+
+def _open_file(file, mode):
+    """returns context of file path opened with utf-8 encoding, or the file object as it."""
+    if isinstance(file, (str, os.PathLike)):
+        return open(file, mode, newline='', encoding='utf-8')
+    return contextlib.nullcontext(file)
+
+
+def _file_format(file):
+    """returns jsonl for file path of .jsonl or .ndjson extension, otherwise csv."""
+    if isinstance(file, (str, os.PathLike)) and os.path.splitext(file)[1].lower() in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    return 'csv'
+
+
+def _read_rows(source, format, columns=None):
+    """returns iterator of rows parsed from csv or jsonl file object, or rows of iterable, tuples are converted to
+    dict by columns."""
+    if hasattr(source, 'read'):
+        if format == 'csv':
+            return csv.DictReader(source, fieldnames=columns)
+        if format == 'jsonl':
+            return (json.loads(line) for line in source if line.strip())
+        raise Exception('unsupported format:' + format)
+    if columns:
+        return (dict(zip(columns, row)) if isinstance(row, (tuple, list)) else row for row in source)
+    return iter(source)
+
+
+def _copy_text(value):
+    """returns value of postgresql COPY text format, dict as json and bytes as bytea hex."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, dict):
+        text = json.dumps(value, default=str)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        text = '\\x' + bytes(value).hex()
+    else:
+        text = str(value)
+    return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _column_names(columns):
+    """returns tuple of column names, columns is None, a column name or names."""
+    if not columns:
+        return ()
+    return (columns,) if isinstance(columns, str) else tuple(columns)
+
+
+def _filter_shape(filters):
+    """returns (shape, args) of filters, the shape is the cache key of where snippet: filter keys, with number of
+    values for __in, __not_in and the boolean value for __isnull."""
+    shape, args = [], []
+    for key, value in filters.items():
+        op = key.rpartition('__')[2] if key.rfind('__') > 0 else None
+        if op == 'in' or op == 'not_in':
+            value = tuple(value)
+            shape.append((key, len(value)))
+            args.extend(value)
+        elif op == 'isnull':
+            shape.append((key, bool(value)))
+        else:
+            shape.append(key)
+            args.append(value)
+    return tuple(shape), args
+
+
+def _entity_dumper(cls):
+    """returns the cached dumper converts entity to dict of {column: value}, see _row_mapper."""
+    dumper = _dumper_cache.get(cls)
+    if dumper is None:
+        dumper = _compile_dumper(cls)
+        _dumper_cache.put(cls, dumper)
+    return dumper
+
+
+def _compile_dumper(cls):
+    renames = {attr: column for column, attr in (getattr(cls, 'COLUMN_MAP', None) or {}).items()}
+    if issubclass(cls, tuple) and hasattr(cls, '_fields'):
+        attributes = cls._fields
+    elif hasattr(cls, '__dataclass_fields__'):
+        attributes = tuple(importlib.import_module('dataclasses').fields(cls))
+        attributes = tuple(f.name for f in attributes)
+    elif not _has_instance_dict(cls):
+        attributes = tuple(_slots(cls))
+        return lambda data: {renames.get(k, k): getattr(data, k) for k in attributes if hasattr(data, k)}
+    elif renames:
+        return lambda data: {renames.get(k, k): v for k, v in vars(data).items()}
+    else:
+        return vars
+    items = ', '.join(f'{renames.get(attr, attr)!r}: data.{attr}' for attr in attributes)
+    namespace = {}
+    exec(f'def dumper(data):\n    return {{{items}}}\n', namespace)
+    return namespace['dumper']
+
+
+class Row(tuple):
+    """A compact row: a tuple of values and the column index map shared by all rows of one result.
+
+    Values are accessible by position or column name: row[0], row['name'], row.get('name'),
+    and like sqlite3.Row iterating a row yields values, row.keys() returns the column names.
+    """
+    __slots__ = ()
+    _columns = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if type(key) is str:
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        return default if index is None else tuple.__getitem__(self, index)
+
+    def keys(self):
+        return list(self._columns)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return list(zip(self._columns, self))
+
+    def as_dict(self):
+        return dict(zip(self._columns, self))
+
+    def __repr__(self):
+        return 'Row(%s)' % ', '.join('%s=%r' % item for item in zip(self._columns, self))
+
+    def __reduce__(self):
+        return _make_row, (self._columns, tuple(self))
+
+
+class Count(int):
+    """The result of find_count, an int reports how it is counted.
+
+    strategy: exact, cached or estimate; source: count, cache or the statistics estimated by;
+    age: seconds the count may be stale, 0 for exact count, None if unknown.
+    """
+
+    def __new__(cls, value, strategy='exact', source='count', age=0.0):
+        count = super().__new__(cls, value)
+        count.strategy = strategy
+        count.source = source
+        count.age = age
+        return count
+
+    def __repr__(self):
+        return 'Count(%d, strategy=%r, source=%r, age=%r)' % (self, self.strategy, self.source, self.age)
+
+
+def _sum_counts(counts):
+    """returns Count of the sum of counts, reports the least accurate strategy and the oldest age."""
+    weakest = max(counts, key=lambda count: _COUNT_STRATEGIES.index(count.strategy))
+    ages = [count.age for count in counts]
+    return Count(sum(counts), weakest.strategy, weakest.source, None if None in ages else max(ages))
+
+
+def _row_class(columns):
+    """returns a Row class shares the column index map of columns."""
+    index = {column: i for i, column in enumerate(columns)}
+    return type('Row', (Row,), {'__slots__': (), '_columns': columns, '_index': index})
+
+
+def _make_row(columns, values):
+    return _row_mapper(Row, [(column,) for column in columns])(values)
+
+
+def _numpy_columns(columns):
+    """convert dict of {column: values list} to dict of {column: numpy array}."""
+    numpy = importlib.import_module('numpy')
+    return {name: _numpy_array(numpy, values) for name, values in columns.items()}
+
+
+def _numpy_array(numpy, values):
+    """returns numpy array of values, number columns with None are float with nan, others are object."""
+    types = set(map(type, values))
+    if types and types <= {bool}:
+        return numpy.array(values, dtype=bool)
+    if types and types <= {int}:
+        try:
+            return numpy.array(values, dtype=numpy.int64)
+        except OverflowError:
+            return numpy.array(values, dtype=object)
+    if types and types <= {int, float, type(None)}:
+        return numpy.array([numpy.nan if v is None else v for v in values], dtype=numpy.float64)
+    return numpy.array(values, dtype=object)
+
+
+_cursor_counter = itertools.count()
+
+# statement types run by postgresql PREPARE and EXECUTE, see DB prepared_statements
+_PREPARED_TYPES = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+
+# dbms: (maximum parameters of one statement, maximum rows of one VALUES clause)
+_MULTI_ROWS_LIMITS = {
+    'sqlite': (999, 1000),
+    'mysql': (65535, 10000),
+    'postgresql': (65535, 10000),
+    'sqlserver': (2100, 1000),
+}
+
+# filter key suffix: sql operator, see DB.find
+_FILTER_OPERATORS = {
+    'ne': '<>', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<=', 'like': ' LIKE ',
+    'in': ' IN ', 'not_in': ' NOT IN ', 'isnull': ' IS NULL',
+}
+
+# the table of insert, replace, update or delete statement after dialect modifiers: OR REPLACE, ... of sqlite,
+# LOW_PRIORITY, IGNORE, ... of mysql and ONLY of postgresql, the table must be followed by what a single table
+# statement continues with, otherwise e.g. joins of update or multiple table delete, the table is unknown
+_written_table_pattern = re.compile(
+    r'\s*(?:(?:INSERT|REPLACE)(?:\s+OR\s+\w+)?(?:\s+(?:LOW_PRIORITY|DELAYED|HIGH_PRIORITY|IGNORE))*(?:\s+INTO)?'
+    r'\s+([\w."`\[\]]+)(?=\s*(?:\(|(?:VALUES|SELECT|DEFAULT|SET|AS)\b))'
+    r'|UPDATE(?:\s+OR\s+\w+)?(?:\s+(?:LOW_PRIORITY|IGNORE|ONLY))*\s+([\w."`\[\]]+)(?:\s+(?:AS\s+)?(?!SET\b)\w+)?'
+    r'\s+SET\b'
+    r'|DELETE(?:\s+(?:LOW_PRIORITY|QUICK|IGNORE))*\s+FROM(?:\s+ONLY)?\s+([\w."`\[\]]+)'
+    r'(?:\s+(?:AS\s+)?(?!(?:WHERE|USING|RETURNING|ORDER|LIMIT)\b)\w+)?'
+    r'\s*(?:(?:WHERE|USING|RETURNING|ORDER|LIMIT)\b|;|$))',
+    re.IGNORECASE)
+
+# dbms: prefix of the statement returns query plan, see DB.explain
+_EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'mysql': 'EXPLAIN ',
+    'postgresql': 'EXPLAIN ',
+}
+
+_literal_pattern = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%s|\$\d+|\?")
+_in_list_pattern = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_repeated_group_pattern = re.compile(r'(\([^()]*\))(?:\s*,\s*\1)+')
+
+# find_count strategies from the most accurate
+_COUNT_STRATEGIES = ('exact', 'cached', 'estimate')
+
+# dbms: (source, sql returns estimated rows and seconds since the statistics updated of table)
+_COUNT_ESTIMATES = {
+    'sqlite': ('sqlite_stat1', 'SELECT stat FROM sqlite_stat1 WHERE tbl = ? ORDER BY idx IS NOT NULL LIMIT 1'),
+    'mysql': ('information_schema', 'SELECT TABLE_ROWS FROM information_schema.TABLES '
+                                    'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s'),
+    'postgresql': ('reltuples', 'SELECT c.reltuples::bigint, '
+                                'extract(epoch FROM now() - greatest(s.last_analyze, s.last_autoanalyze)) '
+                                'FROM pg_class c LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid '
+                                'WHERE c.oid = to_regclass(%s)'),
+    'sqlserver': ('sys.partitions', 'SELECT SUM(rows) FROM sys.partitions '
+                                    'WHERE object_id = OBJECT_ID(%s) AND index_id IN (0, 1)'),
+}
+
+# dbms: limit clause means all rows, which requires limit before offset
+_UNLIMITED_ROWS = {
+    'sqlite': '-1',
+    'mysql': '18446744073709551615',
+}
+
+_CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+_ResultCacheInfo = collections.namedtuple('ResultCacheInfo', ['hits', 'misses', 'evictions', 'invalidations',
+                                                              'currsize'])
+
+
+class _LRUCache:
+    """a thread safe lru cache, maxsize 0 disables it and None means unbounded"""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__data = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                value = self.__data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.__data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize == 0:
+            return
+        with self.__lock:
+            self.__data[key] = value
+            self.__data.move_to_end(key)
+            if self.maxsize is not None and len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+
+    def keys(self):
+        with self.__lock:
+            return list(self.__data.keys())
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """returns cache statistics: hits, misses, maxsize, currsize."""
+        with self.__lock:
+            return _CacheInfo(self.hits, self.misses, self.maxsize, len(self.__data))
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__data
+
+    def __len__(self):
+        return len(self.__data)
+
+
+_mapper_cache = _LRUCache(1024)
+_dumper_cache = _LRUCache(1024)
+
+
+class _SqliteConnector:
+    """the sqlite connection creator of pools, sets row factory and pragmas of new connections.
+    The :memory: database is a named shared cache memory database kept by a keeper connection, so connections of
+    the pool share one database"""
+
+    def __init__(self, sqlite3, row_factory, pragmas=None, shared_memory=False):
+        self.dbapi = sqlite3
+        self.threadsafety = sqlite3.threadsafety
+        self.row_factory = row_factory
+        self.pragmas = dict(pragmas or {})
+        self.memory_uri = None
+        self.keeper = None
+        if shared_memory:
+            self.memory_uri = 'file:dbtool_memory_%x_%x?mode=memory&cache=shared' % (os.getpid(), next(_memory_counter))
+            self.keeper = sqlite3.connect(self.memory_uri, uri=True, check_same_thread=False)
+
+    def connect(self, database=None, **kwargs):
+        if database == ':memory:' and self.memory_uri is not None:
+            database, kwargs['uri'] = self.memory_uri, True
+        conn = self.dbapi.connect(database, **kwargs)
+        conn.row_factory = self.row_factory
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name}={value}').fetchall()
+        return conn
+
+
+_memory_counter = itertools.count()
+
+# the pragmas trade durability of the last transactions on power loss for write throughput, see sqlite docs
+SQLITE_FAST_PRAGMAS = {
+    'busy_timeout': 5000,
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -65536,
+    'mmap_size': 268435456,
+    'temp_store': 'memory',
+}
 
 
 class _DatabaseUrl:
@@ -405,6 +3298,12 @@ class _SqlStatement:
         elif sql.startswith('UPDATE'):
             self.type = 'UPDATE'
             self.is_update = True
+        elif sql.startswith('EXPLAIN'):
+            # read-only unless EXPLAIN ANALYZE runs the explained statement
+            self.type = 'EXPLAIN'
+            self.is_select = 'ANALYZE' not in self.sql[7:30].upper()
 
 
 connect = DB
+connect_async = AsyncDB
+connect_sharded = ShardedDB
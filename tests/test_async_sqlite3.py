@@ -0,0 +1,136 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import dbtool
+
+
+class TestAsyncDB(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.db = dbtool.connect_async('sqlite:///' + self.path, maxconnections=4)
+        await self.db.execute_script("""
+            CREATE TABLE test_user (
+                id   INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT    NOT NULL,
+                age  INTEGER NOT NULL
+            );
+            INSERT INTO test_user(id, name, age) values(1, 'Mario', 18);
+            INSERT INTO test_user(id, name, age) values(2, 'Kai', 18);
+        """)
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        os.remove(self.path)
+
+    async def test_execute(self):
+        rows = await self.db.execute('select * from test_user order by id')
+        self.assertEqual([row['name'] for row in rows], ['Mario', 'Kai'])
+        row = await self.db.execute_fetchone('select * from test_user where id = ?', (2,))
+        self.assertEqual(row['name'], 'Kai')
+
+    async def test_crud(self):
+        row_id = await self.db.insert({'name': 'M', 'age': 1}, table='test_user')
+        self.assertEqual(row_id, 3)
+        await self.db.update({'id': 3, 'age': 2}, table='test_user')
+        user = await self.db.find_one(User, {'id': 3})
+        self.assertEqual(user.age, 2)
+        self.assertEqual(await self.db.find_count({'age': 18}, table=User), 2)
+        self.assertEqual(await self.db.delete(User, {'id': 3}), 1)
+
+    async def test_execute_iter(self):
+        names = [row['name'] async for row in self.db.execute_iter('select * from test_user order by id', chunk_size=1)]
+        self.assertEqual(names, ['Mario', 'Kai'])
+        users = [user async for user in self.db.find_iter(User, {'age': 18})]
+        self.assertEqual(len(users), 2)
+
+    async def test_gather(self):
+        results = await asyncio.gather(*[self.db.find_one(User, {'id': i % 2 + 1}) for i in range(20)])
+        self.assertEqual(len(results), 20)
+
+    async def test_transaction(self):
+        with self.assertRaises(ValueError):
+            async with self.db.transaction():
+                await self.db.execute("INSERT INTO test_user(id, name, age) values(3, 'Q', 100)")
+                row = await self.db.execute_fetchone('select * from test_user where id = 3')
+                self.assertIsNotNone(row, 'row is not None in same transactional.')
+                raise ValueError()
+        self.assertIsNone(await self.db.execute_fetchone('select * from test_user where id = 3'))
+
+        @self.db.transaction
+        async def insert():
+            await self.db.execute("INSERT INTO test_user(id, name, age) values(3, 'Q', 100)")
+            await self.db.execute("INSERT INTO test_user(id, name, age) values(4, 'P', 100)")
+
+        await insert()
+        self.assertEqual(await self.db.find_count({'age': 100}, table=User), 2)
+
+    async def test_transaction_savepoint(self):
+        async with self.db.transaction():
+            await self.db.execute("INSERT INTO test_user(id, name, age) values(3, 'Q', 100)")
+            with self.assertRaises(ValueError):
+                async with self.db.transaction():
+                    await self.db.execute("INSERT INTO test_user(id, name, age) values(4, 'P', 100)")
+                    raise ValueError()
+        self.assertEqual(await self.db.find_count({'age': 100}, table=User), 1)
+
+    async def test_transaction_backpressure(self):
+        async_db = dbtool.connect_async('sqlite:///' + self.path, maxconnections=2)
+
+        async def insert(i):
+            async with async_db.transaction():
+                await async_db.insert({'id': i, 'name': 'T', 'age': 100}, table='test_user')
+                await asyncio.sleep(0.01)
+
+        # transactions beyond maxconnections wait for a connection instead of failing
+        await asyncio.gather(*[insert(i) for i in range(10, 16)])
+        self.assertEqual(await async_db.find_count({'age': 100}, table=User), 6)
+        await async_db.close()
+
+    async def test_iter_backpressure(self):
+        async_db = dbtool.connect_async('sqlite:///' + self.path, maxconnections=1)
+        rows = async_db.execute_iter('select * from test_user order by id', chunk_size=1)
+        self.assertEqual((await rows.__anext__())['name'], 'Mario')
+        # the open iterator holds the connection, another call waits until the iterator is exhausted
+        other = asyncio.create_task(async_db.find_count({}, table=User))
+        await asyncio.sleep(0.05)
+        self.assertFalse(other.done())
+        self.assertEqual([row['name'] async for row in rows], ['Kai'])
+        self.assertEqual(await other, 2)
+        rows = async_db.find_iter(User, chunk_size=1)
+        await rows.__anext__()
+        other = asyncio.create_task(async_db.find_count({}, table=User))
+        await rows.aclose()
+        self.assertEqual(await other, 2)
+        await async_db.close()
+
+    async def test_transaction_no_retry(self):
+        @self.db.transaction
+        async def locked():
+            raise sqlite3.OperationalError('database is locked')
+
+        with self.assertRaises(sqlite3.OperationalError):
+            await locked()
+        # like DB.transaction, a transaction without retry is not counted
+        self.assertEqual(self.db.db.retry_stats(), {'retries': 0, 'recovered': 0, 'exhausted': 0})
+
+    async def test_transaction_task_affinity(self):
+        async with self.db.transaction():
+            await self.db.execute("INSERT INTO test_user(id, name, age) values(3, 'Q', 100)")
+            # another task does not join the transaction of this task
+            other = await asyncio.create_task(self.db.execute_fetchone('select * from test_user where id = 3'))
+            self.assertIsNone(other)
+        self.assertIsNotNone(await self.db.execute_fetchone('select * from test_user where id = 3'))
+
+
+class User:
+    TABLE_NAME = 'test_user'
+
+    def __init__(self, **kwargs):
+        self.id = kwargs.get('id')
+        self.name = kwargs.get('name')
+        self.age = kwargs.get('age')
@@ -1,4 +1,16 @@
+import collections
+import dataclasses
+import importlib.util
+import io
+import json
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+import weakref
 
 import dbtool
 
@@ -32,6 +44,54 @@ class TestDB(unittest.TestCase):
         db.close_cursor(cursor)
         db.execute('select * from test_user')
 
+    def test_execute_iter(self):
+        rows = db.execute_iter('select * from test_user where age = ? order by id', (18,), chunk_size=1)
+        self.assertEqual([row['id'] for row in rows], [1, 2])
+        rows = db.execute_iter('select * from test_user order by id', chunk_size=1)
+        self.assertEqual(next(rows)['id'], 1)
+        self.assertEqual(db._datasource._connections, 1, 'iterator holds the connection')
+        rows.close()
+        self.assertEqual(db._datasource._connections, 0, 'closed iterator releases the connection')
+
+    def test_find_iter(self):
+        users = list(db.find_iter(User, {'age': 18}, chunk_size=1))
+        self.assertEqual([user.name for user in users], ['Mario', 'Kai'])
+
+    def test_execute_row_type(self):
+        rows = db.execute('select id, name from test_user order by id', row_type=tuple)
+        self.assertEqual(rows, [(1, 'Mario'), (2, 'Kai')])
+        row = db.execute_fetchone('select id, name from test_user where id = ?', (1,), row_type=dbtool.Row)
+        self.assertEqual((row[0], row['name'], row.get('id'), row.keys()), (1, 'Mario', 1, ['id', 'name']))
+        self.assertEqual(pickle.loads(pickle.dumps(row)).as_dict(), {'id': 1, 'name': 'Mario'})
+        row = db.execute_fetchone('select id, name from test_user where id = ?', (1,), row_type=sqlite3.Row)
+        self.assertEqual(row['name'], 'Mario')
+        row = db.find_one('test_user', {'id': 1}, return_type=tuple)
+        self.assertEqual(row, (1, 'Mario', 18))
+
+    def test_default_row_type(self):
+        compact_db = dbtool.connect('sqlite:///:memory:', mincached=1, row_type=dbtool.Row)
+        compact_db.execute('create table t (id integer primary key, name text)')
+        compact_db.insert({'name': 'a'}, table='t')
+        row = compact_db.find_one('t', {'id': 1})
+        self.assertEqual((row['id'], row['name']), (1, 'a'))
+        self.assertEqual(compact_db.find_one('t', {'id': 1}, return_type=dict), {'id': 1, 'name': 'a'})
+        self.assertEqual(compact_db.find_count({}, table='t'), 1)
+
+    def test_execute_columns(self):
+        columns = db.execute_columns('select id, name from test_user order by id', chunk_size=1)
+        self.assertEqual(columns, {'id': [1, 2], 'name': ['Mario', 'Kai']})
+        columns = db.execute_columns('select id, name from test_user where id > ?', (10,))
+        self.assertEqual(columns, {'id': [], 'name': []})
+        chunks = list(db.execute_columns_iter('select id from test_user order by id', chunk_size=1))
+        self.assertEqual(chunks, [{'id': [1]}, {'id': [2]}])
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), 'numpy is not installed')
+    def test_execute_columns_numpy(self):
+        columns = db.execute_columns('select id, name, null as score from test_user order by id', as_numpy=True)
+        self.assertEqual(str(columns['id'].dtype), 'int64')
+        self.assertEqual(str(columns['name'].dtype), 'object')
+        self.assertEqual(str(columns['score'].dtype), 'float64')
+
     def test_execute(self):
         row_id = db.execute("insert into test_user(name, age) values(?, ?)", ('Mou', 18))
         self.assertEqual(row_id, 3, 'insert row must be return last autogenerate id')
@@ -101,9 +161,327 @@ class TestDB(unittest.TestCase):
         self.assertEqual(user.name, 'Mario')
         self.assertEqual(user.age, 18)
 
+    def test_find_query(self):
+        db.insert_many([{'name': 'A', 'age': 20}, {'name': 'B', 'age': 30}], table='test_user')
+        rows = db.find('test_user', columns=('id', 'name'), order_by=('-age', 'id'), limit=3, offset=1)
+        self.assertEqual([tuple(row.values()) for row in rows], [(3, 'A'), (1, 'Mario'), (2, 'Kai')])
+        self.assertEqual(list(rows[0].keys()), ['id', 'name'])
+        self.assertEqual([r['id'] for r in db.find('test_user', order_by='id', offset=3)], [4])
+        self.assertEqual([u.id for u in db.find(User, {'id__in': [1, 3, 5]}, order_by='id')], [1, 3])
+        self.assertEqual(db.find(User, {'id__in': []}), [])
+        self.assertEqual(db.find_count({'age__gte': 20, 'age__lt': 30}, table=User), 1)
+        self.assertEqual(db.find_count({'id__not_in': (1, 2), 'name__ne': 'A', 'name__like': '%'}, table=User), 1)
+        self.assertEqual(db.find_count({'name__isnull': True}, table=User), 0)
+        self.assertEqual(db.find_count({'name__isnull': False}, table=User), 4)
+        self.assertEqual(db.find_one(User, {'age': 18}, order_by='-id').id, 2)
+        self.assertEqual(db.delete(User, {'age__gt': 18}), 2)
+
+    def test_find_pages(self):
+        db.insert_many([{'name': 'U%d' % i, 'age': i % 3} for i in range(7)], table='test_user')
+        pages = db.find_pages(User, {'age__lt': 18}, order_by=('-age', 'id'), page_size=3)
+        self.assertEqual([[u.id for u in page] for page in pages], [[5, 8, 4], [7, 3, 6], [9]])
+        pages = db.find_pages('test_user', {'age__lt': 18}, page_size=7, columns=('id',))
+        self.assertEqual([len(page) for page in pages], [7])
+
+    def test_limit_sql(self):
+        sqlserver = dbtool.DB.__new__(dbtool.DB)
+        sqlserver._dbms, sqlserver._placeholder = 'sqlserver', '%s'
+        limit_sql = sqlserver._DB__limit_sql
+        self.assertEqual(limit_sql('SELECT * FROM t', '', 10, None), 'SELECT TOP (%s) * FROM t')
+        self.assertEqual(limit_sql('SELECT * FROM t', 'id', None, 5), 'SELECT * FROM t ORDER BY id OFFSET %s ROWS')
+        self.assertEqual(limit_sql('SELECT * FROM t', '', 10, 5),
+                         'SELECT * FROM t ORDER BY (SELECT NULL) OFFSET %s ROWS FETCH NEXT %s ROWS ONLY')
+
+    def test_find_entity_types(self):
+        user = db.find_one('test_user', {'id': 1}, return_type=DataUser)
+        self.assertEqual(user, DataUser(id=1, name='Mario', age=18))
+        user = db.find_one('test_user', {'id': 1}, return_type=SlotsUser)
+        self.assertEqual((user.id, user.name, user.age), (1, 'Mario', 18))
+        users = db.find('test_user', {'age': 18}, return_type=TupleUser)
+        self.assertEqual(users[1], TupleUser(2, 'Kai', 18))
+        user = db.find_one('test_user', {'id': 2}, return_type=RenamedUser)
+        self.assertEqual(user.username, 'Kai')
+
+    def test_insert_entity_types(self):
+        db.insert(DataUser(id=None, name='D', age=1), table='test_user')
+        db.insert(TupleUser(None, 'T', 2), table='test_user')
+        db.insert(RenamedUser(username='R', age=3))
+        self.assertEqual([u.name for u in db.find(User, {'id': 3})], ['D'])
+        self.assertEqual(db.find_one(User, {'id': 5}).name, 'R')
+
     def test_find_count(self):
         count = db.find_count({'id': 1}, table=User)
         self.assertEqual(count, 1)
+        self.assertEqual((count.strategy, count.age), ('exact', 0))
+
+    def test_find_count_strategy(self):
+        count = db.find_count({}, table='test_user', strategy='cached', ttl=60)
+        self.assertEqual((count, count.strategy), (2, 'cached'))
+        self.assertEqual(db.find_count({}, table='test_user', strategy='cached').strategy, 'cached')
+        self.assertEqual(db.count_cache.info().hits, 1)
+        db.insert({'name': 'Q', 'age': 1}, table='test_user')
+        self.assertEqual(db.find_count({}, table='test_user', strategy='cached'), 3, 'invalidated by insert')
+        # estimate falls back to exact count without statistics or with filters on sqlite
+        count = db.find_count({}, table='test_user', strategy='estimate')
+        self.assertEqual((count, count.strategy), (3, 'exact'))
+        db.execute('ANALYZE test_user')
+        db.insert({'name': 'P', 'age': 1}, table='test_user')
+        count = db.find_count({}, table='test_user', strategy='estimate')
+        self.assertEqual((count, count.strategy, count.source, count.age), (3, 'estimate', 'sqlite_stat1', None))
+        self.assertEqual(db.find_count({'age': 1}, table='test_user', strategy='estimate').strategy, 'exact')
+        db.count_strategy(User, 'cached', ttl=None)
+        try:
+            self.assertEqual(db.find_count({'age': 1}, table=User).strategy, 'cached')
+        finally:
+            db.count_strategy(User)
+        self.assertEqual(pickle.loads(pickle.dumps(count)).source, 'sqlite_stat1')
+        with self.assertRaises(Exception):
+            db.find_count({}, table='test_user', strategy='fast')
+
+    def test_insert_many(self):
+        users = [{'name': 'A', 'age': 1}, User(name='B', age=2), {'name': 'C', 'age': 3}]
+        rows = db.insert_many(users, table='test_user')
+        self.assertEqual(rows, 3)
+        ids = db.insert_many([{'name': 'D', 'age': 4}, {'id': 10, 'name': 'E', 'age': 5}, {'name': 'F', 'age': 6}],
+                             table='test_user', batch_size=1, return_ids=True)
+        self.assertEqual(ids, [6, 10, 7])
+        self.assertEqual(db.find_count({}, table=User), 8)
+        # ids of None are generated
+        ids = db.insert_many([User(name='G', age=7), User(name='H', age=8), {'id': None, 'name': 'I', 'age': 9}],
+                             return_ids=True, table=User)
+        self.assertEqual(ids, [11, 12, 13])
+        self.assertEqual(db.find_one(User, {'id': 12}).name, 'H')
+
+    def test_update_many(self):
+        rows = db.update_many([{'id': 1, 'age': 20}, {'id': 2, 'name': 'K', 'age': 21}], table='test_user')
+        self.assertEqual(rows, 2)
+        self.assertEqual(db.find_one(User, {'id': 1}).age, 20)
+        self.assertEqual(db.find_one(User, {'id': 2}).name, 'K')
+
+    def test_upsert_many(self):
+        rows = [{'id': 1, 'name': 'Mario', 'age': 30}, {'id': 3, 'name': 'New', 'age': 1}]
+        db.upsert_many(rows, table='test_user')
+        self.assertEqual(db.find_one(User, {'id': 1}).age, 30)
+        self.assertEqual(db.find_one(User, {'id': 3}).name, 'New')
+        db.upsert_many([{'id': 1, 'name': 'Mario', 'age': 40}], table='test_user', update_columns=())
+        self.assertEqual(db.find_one(User, {'id': 1}).age, 30)
+
+    def test_import_export(self):
+        source = io.StringIO('name,age\nA,1\nB,2\nC,3\n')
+        offsets = []
+        self.assertEqual(db.import_rows('test_user', source, chunk_size=2, progress=offsets.append), 3)
+        self.assertEqual(offsets, [2, 3])
+        rows = ['{"name": "D", "age": 4}', '', '{"name": "E", "age": 5}']
+        self.assertEqual(db.import_rows('test_user', io.StringIO('\n'.join(rows)), format='jsonl', start=1), 2)
+        self.assertEqual(db.import_rows(User, [('F', 6)], columns=('name', 'age')), 1)
+        self.assertEqual([u.name for u in db.find(User, {'id__gt': 2}, order_by='id')], ['A', 'B', 'C', 'E', 'F'])
+
+        sink = io.StringIO()
+        sql = 'select id, name from test_user where id <= ? order by id'
+        self.assertEqual(db.export_query(sql, sink, (4,), chunk_size=3), 4)
+        self.assertEqual(sink.getvalue().splitlines(), ['id,name', '1,Mario', '2,Kai', '3,A', '4,B'])
+        sink = io.StringIO()
+        self.assertEqual(db.export_query('select name from test_user where id = 1', sink, format='jsonl'), 1)
+        self.assertEqual(sink.getvalue(), '{"name": "Mario"}\n')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'users.jsonl')
+            self.assertEqual(db.export_query('select name, age from test_user', path), 7)
+            db.execute('delete from test_user')
+            self.assertEqual(db.import_rows('test_user', path), 7)
+        # the postgresql COPY text format
+        values = [None, 'a\tb\\', {'k': 'v\n'}, b'\x00\xff', 1.5]
+        expected = ['\\N', 'a\\tb\\\\', '{"k": "v\\\\n"}', '\\\\x00ff', '1.5']
+        self.assertEqual([dbtool._copy_text(value) for value in values], expected)
+
+    def test_statement_cache(self):
+        db.statement_cache.clear()
+        db.find_one(User, {'id': 1})
+        db.find_one(User, {'id': 2})
+        db.find(User, {'id': 1})
+        db.find(User, {'id': 2})
+        info = db.statement_cache.info()
+        self.assertEqual(info.misses, 2)
+        self.assertEqual(info.hits, 2)
+        self.assertIn(('SELECT', User, ('id',), 'sqlite', (), (), True, False, False), db.statement_cache)
+        db.find(User, {'id__in': [1, 2]})
+        db.find(User, {'id__in': [1, 2, 3]})
+        db.insert({'name': 'M', 'age': 18}, table='test_user')
+        self.assertEqual(db.statement_cache.info().currsize, 5)
+
+    def test_result_cache(self):
+        cache = db.enable_result_cache(ttl=60, maxsize=2)
+        try:
+            self.assertEqual(db.find_one(User, {'id': 1}).name, 'Mario')
+            self.assertEqual(db.find_one(User, {'id': 1}).name, 'Mario')
+            self.assertEqual(db.find_one('test_user', {'id': 1}, return_type=tuple), (1, 'Mario', 18))
+            self.assertEqual(db.find_count({'age': 18}, table=User), 2)
+            self.assertEqual(cache.info().hits, 2)
+            db.execute('update test_user set name = ? where id = ?', ('M', 1))
+            self.assertEqual(db.find_one(User, {'id': 1}).name, 'M')
+            with db.transaction():
+                db.update({'id': 1, 'name': 'N'}, table='test_user')
+                self.assertEqual(db.find_one(User, {'id': 1}).name, 'N')
+                self.assertEqual(len(cache.backend), 1)
+            self.assertEqual(len(cache.backend), 0)
+            self.assertIsNone(db.find_one(User, {'id': 3}))
+            self.assertIsNone(db.find_one(User, {'id': 3}))
+            self.assertEqual(db.find_count({}, table=User), 2)
+            self.assertEqual(len(cache.backend), 1, 'exact counts bypass the result cache')
+            db.find(User)
+            info = cache.info()
+            self.assertEqual((info.hits, info.misses, info.evictions, info.invalidations), (3, 4, 0, 2))
+            # a write invalidates between the query of a miss and its put, the stale result is not cached
+            cache.invalidate()
+            writes = []
+
+            class WriteListener(dbtool.Listener):
+                def after_execute(self, statement, args, elapsed, rows, error):
+                    if statement.is_select and not writes:
+                        writes.append(db.execute('update test_user set name = ? where id = ?', ('O', 1)))
+
+            listener = db.add_listener(WriteListener())
+            try:
+                self.assertEqual(db.find_one(User, {'id': 1}).name, 'N')
+            finally:
+                db.remove_listener(listener)
+            self.assertEqual((writes, len(cache.backend)), ([1], 0))
+            self.assertEqual(db.find_one(User, {'id': 1}).name, 'O')
+            generation = cache.generation('test_user')
+            cache.invalidate(['other'])
+            cache.put('key', 'value', 'test_user', generation)
+            self.assertEqual(cache.get('key'), 'value', 'invalidation of other tables keeps the put')
+            db.explain('select * from test_user where id = ?', (1,))
+            self.assertEqual((cache.info().invalidations, len(cache.backend)), (5, 2), 'explain is read-only')
+            self.assertEqual(db.find_count({'age': 18}, table=User, strategy='estimate'), 2)
+            self.assertEqual(len(cache.backend), 2, 'estimates do not flush the result cache')
+        finally:
+            db.disable_result_cache()
+
+    def test_session(self):
+        events = []
+
+        class EventListener(dbtool.Listener):
+            def after_execute(self, statement, args, elapsed, rows, error):
+                events.append(statement.sql)
+
+        listener = db.add_listener(EventListener())
+        try:
+            with db.session() as session:
+                mario = session.get(User, 1)
+                self.assertIs(session.find(User, {'age': 18}, order_by='id')[0], mario)
+                mario.age = 20
+                kai = session.find_one('test_user', {'id': 2})
+                kai.name = 'K'  # the loaded User of id 2
+                session.add(User(name='New', age=1))
+                self.assertEqual(session.dirty(mario), {'age': 20})
+                del events[:]
+            self.assertEqual(len(events), 3)
+            self.assertIn('UPDATE test_user SET age=? WHERE id = ?', events)
+            self.assertEqual(db.find_one(User, {'id': 1}).age, 20)
+            self.assertEqual(db.find_one(User, {'id': 2}).name, 'K')
+            self.assertEqual(session.get(User, 3).name, 'New')
+            self.assertEqual(session.dirty(mario), {})
+
+            session = db.session()
+            refs = [session.ref(User, i) for i in (1, 2, 3, 4)]
+            del events[:]
+            self.assertEqual([ref.get() and ref.get().id for ref in refs], [1, 2, 3, None])
+            self.assertEqual(len(events), 1)
+            session.delete(refs[0].get())
+            session.commit()
+            self.assertIsNone(db.find_one(User, {'id': 1}))
+        finally:
+            db.remove_listener(listener)
+
+    def test_profile(self):
+        with db.profile(explain_threshold=0, n_plus_one_threshold=2) as profiler:
+            for i in (1, 2, 3):
+                db.find_one('test_user', {'id': i})
+            db.execute("select * from test_user where name = 'Kai' and age in (18, 19)")
+        db.find_one('test_user', {'id': 1})
+        report = json.loads(profiler.to_json())
+        # statements are sorted by total seconds, order them by count to not depend on timing
+        find_one, select = sorted(report['statements'], key=lambda statement: -statement['count'])
+        self.assertEqual((find_one['sql'], find_one['count'], find_one['rows']),
+                         ('SELECT * FROM test_user WHERE id=? LIMIT ?', 3, 2))
+        self.assertIn('USING INTEGER PRIMARY KEY', find_one['plan'][0][-1])
+        self.assertEqual(select['sql'], 'select * from test_user where name = ? and age in (...)')
+        self.assertEqual(report['n_plus_one'], [{'sql': find_one['sql'], 'count': 3, 'scopes': 1, 'max': 3}])
+        with db.profile() as profiler:
+            db.execute('create table test_profile (id integer primary key)')
+            db.execute('drop table test_profile')
+        self.assertEqual([statement['rows'] for statement in profiler.report()['statements']], [0, 0])
+        self.assertEqual(dbtool._normalize_sql('INSERT INTO t(a, b) VALUES(?, ?), (?, ?)'),
+                         'INSERT INTO t(a, b) VALUES(...), ...')
+        # sampling profiler records no statements at rate 0, N+1 is still counted in scope
+        profiler = db.enable_profiler(sample_rate=0, n_plus_one_threshold=2)
+        with profiler.scope():
+            db.find_one('test_user', {'id': 1})
+            db.find_one('test_user', {'id': 2})
+        db.disable_profiler()
+        self.assertEqual(profiler.report()['statements'], [])
+        self.assertEqual(profiler.report()['n_plus_one'][0]['count'], 2)
+
+    def test_replace_placeholder(self):
+        pattern = dbtool._placeholder_pattern('postgresql')
+        sql = "select '?', \"a?\" from t /* ? */ where a = ? and j ?| array['x'] and b = ? -- ?"
+        expected = "select '?', \"a?\" from t /* ? */ where a = %s and j ?| array['x'] and b = %s -- ?"
+        self.assertEqual(dbtool._replace_placeholder(sql, '%s', pattern), expected)
+        pattern = dbtool._placeholder_pattern('mysql')
+        sql = "select 'it\\'s ?', `a?` from t where a = ?"
+        expected = "select 'it\\'s ?', `a?` from t where a = %s"
+        self.assertEqual(dbtool._replace_placeholder(sql, '%s', pattern), expected)
+        sql = 'select "it\\"s ?", "a "" ?", ?'
+        self.assertEqual(dbtool._replace_placeholder(sql, '%s', pattern), 'select "it\\"s ?", "a "" ?", %s')
+
+    def test_written_tables(self):
+        statements = ['INSERT OR REPLACE INTO t (a) VALUES (1)', 'INSERT OR IGNORE INTO "t" VALUES (1)',
+                      'INSERT LOW_PRIORITY IGNORE INTO s.t (a) VALUES (1)', 'INSERT IGNORE t SET a = 1',
+                      'REPLACE DELAYED INTO `t` VALUES (1)', 'INSERT INTO t DEFAULT VALUES',
+                      'UPDATE OR REPLACE t SET a = 1', 'UPDATE OR IGNORE t SET a = 1', 'UPDATE ONLY t SET a = 1',
+                      'UPDATE LOW_PRIORITY IGNORE t AS x SET a = 1', 'DELETE FROM ONLY t WHERE a = 1',
+                      'DELETE LOW_PRIORITY QUICK IGNORE FROM t WHERE a = 1', 'DELETE FROM t']
+        self.assertEqual([dbtool._written_tables(sql) for sql in statements], [('t',)] * len(statements))
+        # joins and multiple tables are unknown, all tables are invalidated
+        statements = ['UPDATE t1 JOIN t2 ON t1.id = t2.id SET a = 1', 'UPDATE t1, t2 SET a = 1',
+                      'DELETE t1 FROM t1 JOIN t2', 'DELETE FROM t1, t2 USING t1 JOIN t2',
+                      'INSERT INTO t PARTITION (p0) VALUES (1)']
+        self.assertEqual([dbtool._written_tables(sql) for sql in statements], [None] * len(statements))
+        cache = db.enable_result_cache()
+        try:
+            self.assertEqual(db.find_one(User, {'id': 1}).name, 'Mario')
+            db.execute('UPDATE OR REPLACE test_user SET name = ? WHERE id = ?', ('M', 1))
+            self.assertEqual(db.find_one(User, {'id': 1}).name, 'M')
+            self.assertEqual(cache.info().hits, 0)
+        finally:
+            db.disable_result_cache()
+
+    def test_stats(self):
+        stats_db = dbtool.connect('sqlite:///:memory:', mincached=1)
+        events = []
+
+        class EventListener(dbtool.Listener):
+            def after_execute(self, statement, args, elapsed, rows, error):
+                events.append((statement.type, rows, error is not None))
+
+        listener = stats_db.add_listener(EventListener())
+        stats_db.enable_stats(slow_query_threshold=0)
+        stats_db.execute('create table t (id integer primary key, name text)')
+        with stats_db.transaction():
+            stats_db.insert({'name': 'a'}, table='t')
+        stats_db.find('t', {'id': 1})
+        with self.assertRaises(Exception):
+            stats_db.execute('select * from missing_table')
+        stats_db.remove_listener(listener)
+        stats_db.execute('select 1')
+        expected = [(None, -1, False), ('INSERT', 1, False), ('SELECT', 1, False), ('SELECT', None, True)]
+        self.assertEqual(events, expected)
+        stats = stats_db.stats()
+        self.assertEqual(stats['statements']['SELECT']['count'], 3)
+        self.assertEqual(stats['statements']['SELECT']['errors'], 1)
+        self.assertEqual(stats['transactions'], {'begin': 1, 'commit': 1, 'rollback': 0})
+        self.assertEqual(stats['checkouts']['count'], 5)
+        self.assertEqual(len(stats['slow_queries']), 5)
 
     def test_transactional(self):
         # case rollback
@@ -149,6 +527,46 @@ class TestDB(unittest.TestCase):
         row = db.execute_fetchone("select * from test_user where id = 3")
         self.assertIsNotNone(row, 'row is not None in same transactional.')
 
+    def test_transactional_savepoint(self):
+        with db.transaction():
+            db.execute("INSERT INTO test_user(id, name, age) values(3, 'Q', 100)")
+            with self.assertRaises(ValueError):
+                with db.transaction():
+                    db.execute("INSERT INTO test_user(id, name, age) values(4, 'P', 100)")
+                    raise ValueError()
+            self.assertIsNone(db.execute_fetchone("select * from test_user where id = 4"), 'inner rolled back')
+        self.assertEqual(db.find_count({'age': 100}, table='test_user'), 1, 'outer committed')
+
+    def test_transactional_retry(self):
+        before = db.retry_stats()
+        calls = []
+
+        @db.transaction(retry=3, backoff=0.001)
+        def insert():
+            calls.append(len(calls))
+            db.execute("INSERT INTO test_user(id, name, age) values(3, 'Q', 100)")
+            if len(calls) < 3:
+                raise sqlite3.OperationalError('database is locked')
+
+        insert()
+        self.assertEqual((len(calls), db.find_count({'age': 100}, table='test_user')), (3, 1))
+        with self.assertRaises(ValueError):
+            db.transaction(lambda: calls.append(0) or self.fail_with(ValueError()), retry=3)()
+        self.assertEqual(len(calls), 4, 'non transient error does not retry')
+        after = db.retry_stats()
+        changes = {key: after[key] - before[key] for key in after}
+        self.assertEqual(changes, {'retries': 2, 'recovered': 1, 'exhausted': 0})
+
+    @staticmethod
+    def fail_with(error):
+        raise error
+
+    def test_transactional_ended(self):
+        with db.transaction():
+            db.execute("INSERT INTO test_user(id, name, age) values(3, 'Q', 100)")
+        db.execute("INSERT INTO test_user(id, name, age) values(4, 'P', 100)")
+        self.assertIsNone(db._transaction_ctx.conn, 'connection should not be kept in transaction')
+
     def test_transactional_decorator(self):
         # case rollback
         try:
@@ -177,6 +595,21 @@ class TestDB(unittest.TestCase):
         raise Exception()
 
 
+class RecordingCursor:
+
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, sql, args=()):
+        self.executed.append((sql, args))
+
+
+class RecordingConnection:
+
+    def __init__(self):
+        self._con = RecordingCursor()
+
+
 class User:
     TABLE_NAME = 'test_user'
 
@@ -184,3 +617,386 @@ class User:
         self.id = kwargs.get('id')
         self.name = kwargs.get('name')
         self.age = kwargs.get('age')
+
+
+class TestReplicas(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.urls = ['sqlite:///' + os.path.join(self.dir.name, name) for name in ('primary.db', 'r1.db', 'r2.db')]
+        for url in self.urls:
+            node = dbtool.connect(url)
+            node.execute('create table node (id integer primary key, name text)')
+            node.insert({'id': 1, 'name': url.rsplit('/', 1)[1]}, table='node')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_round_robin(self):
+        db = dbtool.connect(self.urls[0], replicas=self.urls[1:])
+        names = [db.find_one('node', {'id': 1})['name'] for _ in range(4)]
+        self.assertEqual(names, ['r1.db', 'r2.db', 'r1.db', 'r2.db'])
+        db.update({'id': 1, 'name': 'updated'}, table='node')
+        self.assertEqual(db.execute_fetchone('select name from node')['name'], 'r1.db')
+        with db.use_primary():
+            self.assertEqual(db.execute_fetchone('select name from node')['name'], 'updated')
+        with db.transaction():
+            self.assertEqual(db.find_one('node', {'id': 1})['name'], 'updated')
+
+    def test_explain(self):
+        for url in self.urls[1:]:
+            dbtool.connect(url).execute('create table replica_only (id integer primary key)')
+        db = dbtool.connect(self.urls[0], replicas=self.urls[1:])
+        self.assertTrue(db.explain('select * from replica_only'))
+        with self.assertRaises(Exception):
+            with db.use_primary():
+                db.explain('select * from replica_only')
+
+    def test_least_outstanding(self):
+        db = dbtool.connect(self.urls[0], replicas=self.urls[1:], balance='least_outstanding')
+        rows = db.execute_iter('select name from node')
+        self.assertEqual(next(rows)['name'], 'r1.db')
+        self.assertEqual(db.find_one('node', {'id': 1})['name'], 'r2.db')
+        self.assertEqual(db.find_one('node', {'id': 1})['name'], 'r2.db')
+        rows.close()
+        self.assertEqual(db.find_one('node', {'id': 1})['name'], 'r1.db')
+
+
+class TestGather(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        url = 'sqlite:///' + os.path.join(self.dir.name, 'gather.db')
+        self.db = dbtool.connect(url, maxconnections=4, blocking=True)
+        self.db.execute('create table test_user (id integer primary key, name text, age integer)')
+        self.db.insert_many([User(id=i, name='u%d' % i, age=i % 2) for i in range(1, 10)])
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_gather(self):
+        results = self.db.gather([
+            'select count(*) total from test_user',
+            ('select name from test_user where id = ?', (3,)),
+            lambda: self.db.find_one(User, {'id': 5}),
+            'select * from missing_table',
+        ], return_exceptions=True)
+        self.assertEqual(results[0], [{'total': 9}])
+        self.assertEqual(results[1], [{'name': 'u3'}])
+        self.assertEqual(results[2].name, 'u5')
+        self.assertIsInstance(results[3], sqlite3.OperationalError)
+        with self.assertRaises(sqlite3.OperationalError):
+            self.db.gather(['select 1', 'select * from missing_table'])
+
+    def test_gather_in_transaction(self):
+        with self.assertRaises(Exception):
+            with self.db.transaction():
+                self.db.gather(['select 1'])
+
+    def test_gather_close(self):
+        self.assertEqual(self.db.gather(['select 1 one']), [[{'one': 1}]])
+        executor = self.db._executor
+        self.db.close()
+        self.assertIsNone(self.db._executor)
+        self.assertTrue(executor._shutdown, 'close shuts down the gather executor')
+
+
+class TestSqliteEngine(unittest.TestCase):
+
+    def test_shared_memory(self):
+        connect = sqlite3.connect
+        memory_db = dbtool.connect('sqlite:///:memory:', maxconnections=2)
+        self.assertIs(sqlite3.connect, connect)
+        memory_db.execute('create table t (id integer primary key)')
+        memory_db.insert({'id': 1}, table='t')
+        cursor = memory_db.execute_cursor('select * from t')
+        # another pooled connection sees the same database
+        self.assertEqual(memory_db.find_count({}, table='t'), 1)
+        memory_db.close_cursor(cursor)
+        self.assertEqual(dbtool.connect('sqlite:///:memory:').execute("select * from sqlite_master"), [])
+
+    def test_reuse_cursors(self):
+        with tempfile.TemporaryDirectory() as directory:
+            url = 'sqlite:///' + os.path.join(directory, 'engine.db')
+            engine_db = dbtool.connect(url, reuse_cursors=True, timeout=0.1)
+            engine_db.execute('create table t (id integer primary key, name text)')
+            engine_db.insert_many([{'name': 'a'}, {'name': 'b'}], table='t')
+            self.assertEqual(engine_db.find_one('t', {'id': 2}, return_type=tuple), (2, 'b'))
+            self.assertEqual(engine_db.find_one('t', {'id': 2})['name'], 'b')
+            self.assertEqual(engine_db.execute_fetchone('select * from t order by id')['id'], 1)
+            # the unread rows of the reused cursor do not lock the database
+            dbtool.connect(url, timeout=0.1).insert({'name': 'c'}, table='t')
+            self.assertEqual(len(engine_db.execute('select * from t', row_type=tuple)), 3)
+
+    def test_numbered_placeholders(self):
+        sql = "select * from t where a = %s and b like 'x%%' and c in (%s, %s)"
+        expected = "select * from t where a = $1 and b like 'x%' and c in ($2, $3)"
+        self.assertEqual(dbtool._numbered_placeholders(sql), expected)
+
+    def test_prepared_statements(self):
+        # the postgresql PREPARE and EXECUTE path, run on a recording cursor
+        engine_db = dbtool.connect('sqlite:///:memory:')
+        engine_db._prepared, engine_db._prepared_limit = weakref.WeakKeyDictionary(), 2
+        conn, cursor = RecordingConnection(), RecordingCursor()
+
+        def execute(sql, args=()):
+            cursor.executed.clear()
+            engine_db._DB__execute_prepared(conn, cursor, dbtool._SqlStatement(sql), args)
+            return cursor.executed
+
+        executed = execute('SELECT * FROM t WHERE id = %s', (1,))
+        name = executed[0][0].split()[1]
+        self.assertEqual(executed, [(f'PREPARE {name} AS SELECT * FROM t WHERE id = $1', ()),
+                                    (f'EXECUTE {name} (%s)', (1,))])
+        self.assertEqual(execute('SELECT * FROM t WHERE id = %s', (2,)), [(f'EXECUTE {name} (%s)', (2,))])
+        self.assertEqual(execute('CREATE TABLE u (id int)'), [('CREATE TABLE u (id int)', ())], 'ddl runs directly')
+
+        executed = execute('UPDATE t SET a = 1')
+        update_name = executed[0][0].split()[1]
+        execute('SELECT * FROM t WHERE id = %s', (3,))
+        executed = execute('DELETE FROM t')
+        self.assertEqual(executed[0], ('DEALLOCATE ' + update_name, ()), 'least recently used is deallocated')
+        self.assertEqual(len(engine_db._prepared[conn._con]), 2)
+
+        engine_db._prepared_limit = None
+        for i in range(5):
+            execute('SELECT %d' % i)
+        self.assertEqual(len(engine_db._prepared[conn._con]), 7, 'None is unbounded')
+
+    def test_thread_local(self):
+        with tempfile.TemporaryDirectory() as directory:
+            url = 'sqlite:///' + os.path.join(directory, 'engine.db')
+            engine_db = dbtool.connect(url, thread_local=True, pragmas=dbtool.SQLITE_FAST_PRAGMAS)
+            self.assertEqual(engine_db.execute_fetchone('pragma journal_mode')['journal_mode'], 'wal')
+            self.assertEqual(engine_db.execute_fetchone('pragma synchronous')['synchronous'], 1)
+            engine_db.execute('create table t (id integer primary key, name text)')
+            engine_db.insert_many([{'name': 'a'}, {'name': 'b'}], table='t')
+            counts = engine_db.gather([lambda: engine_db.find_count({}, table='t')] * 4)
+            self.assertEqual(counts, [2, 2, 2, 2])
+            with self.assertRaises(ValueError):
+                with engine_db.transaction():
+                    engine_db.insert({'name': 'c'}, table='t')
+                    raise ValueError()
+            self.assertEqual(engine_db.find_count({}, table='t'), 2)
+
+    def test_transaction_retry_locked(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'engine.db')
+            engine_db = dbtool.connect('sqlite:///' + path, timeout=0.01)
+            engine_db.execute('create table t (id integer primary key, name text)')
+            holder = sqlite3.connect(path, check_same_thread=False)
+            holder.execute('begin immediate')
+            timer = threading.Timer(0.2, holder.commit)
+            timer.start()
+            insert = engine_db.transaction(lambda: engine_db.insert({'name': 'a'}, table='t'), retry=50, backoff=0.02,
+                                           max_backoff=0.05)
+            self.assertEqual(insert(), 1)
+            timer.join()
+            holder.close()
+            self.assertGreater(engine_db.retry_stats()['retries'], 0)
+            self.assertEqual(engine_db.retry_stats()['recovered'], 1)
+            with self.assertRaises(sqlite3.OperationalError):
+                holder = sqlite3.connect(path)
+                holder.execute('begin immediate')
+                engine_db.transaction(lambda: engine_db.insert({'name': 'b'}, table='t'), retry=1, backoff=0.001)()
+            holder.close()
+            self.assertEqual(engine_db.retry_stats()['exhausted'], 1)
+
+
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.url = 'sqlite:///' + os.path.join(self.directory.name, 'pool.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_warm_up(self):
+        pool_db = dbtool.connect(self.url, maxconnections=2, blocking=True)
+        self.assertEqual(pool_db.warm_up(), 2)
+        self.assertEqual(pool_db.warm_up(), 0)
+        cursor = pool_db.execute_cursor('select 1')
+        status = pool_db.pool_status()
+        self.assertEqual((status['in_use'], status['idle'], status['max'], status['created']), (1, 1, 2, 2))
+        pool_db.close_cursor(cursor)
+        self.assertEqual(pool_db.pool_status()['idle'], 2)
+
+    def test_waiting(self):
+        pool_db = dbtool.connect(self.url, maxconnections=1, blocking=True, check_same_thread=False)
+        cursor = pool_db.execute_cursor('select 1')
+        thread = threading.Thread(target=pool_db.execute, args=('select 1',))
+        thread.start()
+        while pool_db.pool_status()['waiting'] == 0:
+            time.sleep(0.001)
+        pool_db.close_cursor(cursor)
+        thread.join()
+        self.assertEqual(pool_db.pool_status()['waiting'], 0)
+
+    def test_lifetime(self):
+        pool_db = dbtool.connect(self.url, max_lifetime=0.05, reap_interval=60)
+        cursor = pool_db.execute_cursor('select 1')
+        time.sleep(0.06)
+        pool_db.close_cursor(cursor)
+        status = pool_db.pool_status()
+        self.assertEqual((status['idle'], status['reaped']), (0, 1), 'expired connection is closed at checkin')
+
+    def test_idle_timeout(self):
+        pool_db = dbtool.connect(self.url, mincached=1, maxconnections=3, idle_timeout=0.05, reap_interval=0.01)
+        pool_db.warm_up(3)
+        deadline = time.monotonic() + 5
+        while pool_db.pool_status()['reaped'] < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        status = pool_db.pool_status()
+        self.assertGreaterEqual(status['reaped'], 3)
+        self.assertEqual(status['idle'], 0, 'reaping only closes connections')
+        pool_db.close()
+        # connections are refilled to mincached at the next checkout
+        self.assertEqual(pool_db.execute_fetchone('select 1 one'), {'one': 1})
+        self.assertEqual(pool_db.pool_status()['idle'], 1)
+        self.assertEqual(pool_db.find_count({}, table='sqlite_master'), 0)
+
+    def test_reap_check_same_thread(self):
+        pool_db = dbtool.connect(self.url, mincached=1, idle_timeout=60, check_same_thread=True)
+        pool_db.warm_up(2)
+        for con in pool_db._datasource._idle_cache:
+            con._dbtool_used -= 120
+        thread = threading.Thread(target=pool_db._datasource.reap)
+        thread.start()
+        thread.join()
+        self.assertEqual(pool_db.pool_status()['reaped'], 2)
+        # the refill runs in the checkout thread, its connections work with check_same_thread
+        self.assertEqual(pool_db.execute_fetchone('select 1 one'), {'one': 1})
+
+    def test_thread_local(self):
+        pool_db = dbtool.connect(self.url, thread_local=True, max_lifetime=0.05)
+        pool_db.execute('select 1')
+        time.sleep(0.06)
+        pool_db.execute('select 1')
+        status = pool_db.pool_status()
+        self.assertEqual((status['in_use'], status['created'], status['reaped']), (1, 1, 1))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_fork(self):
+        pool_db = dbtool.connect(self.url, mincached=1)
+        pool_db.execute('create table t (id integer primary key)')
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                pool_db.insert({'id': 1}, table='t')
+                os.write(write, json.dumps(pool_db.pool_status()).encode())
+            finally:
+                os._exit(0)
+        os.close(write)
+        with os.fdopen(read) as f:
+            status = json.loads(f.read())
+        os.waitpid(pid, 0)
+        self.assertEqual(status['created'], 2, 'child opens its own connection')
+        self.assertEqual(pool_db.find_count({}, table='t'), 1)
+        self.assertEqual(pool_db.pool_status()['created'], 1, 'parent connection is kept')
+
+
+class TestWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        url = 'sqlite:///' + os.path.join(self.dir.name, 'writer.db')
+        self.db = dbtool.connect(url, mincached=1)
+        self.db.execute('create table test_user (id integer primary key, name text, age integer)')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_writer(self):
+        with self.db.writer(table='test_user', batch_size=10, flush_interval=None) as writer:
+            for i in range(25):
+                writer.insert({'name': 'u%d' % i, 'age': i})
+            self.assertTrue(writer.flush(timeout=5))
+            self.assertEqual(self.db.find_count({}, table='test_user'), 25)
+            self.assertEqual(writer.metrics()['flushes'], 3)
+            writer.insert(User(name='u', age=1), table=User)
+        self.assertEqual(self.db.find_count({}, table='test_user'), 26)
+        with self.assertRaises(Exception):
+            writer.insert({'name': 'closed', 'age': 1})
+
+    def test_writer_error(self):
+        errors = []
+        writer = self.db.writer(flush_interval=0.01, on_error=lambda e, rows: errors.append((e, rows)))
+        writer.insert({'name': 'ok', 'age': 1}, table='test_user')
+        writer.insert({'missing': 1}, table='test_user')
+        writer.close()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(len(errors[0][1]), 2)
+        self.assertEqual(writer.metrics()['failed'], 2)
+        self.assertEqual(self.db.find_count({}, table='test_user'), 0)
+
+
+class TestShardedDB(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        urls = ['sqlite:///' + os.path.join(self.dir.name, 'shard%d.db' % i) for i in range(3)]
+        self.db = dbtool.connect_sharded(urls, shard_key='id')
+        for shard in self.db.shards:
+            shard.execute('create table test_user (id integer primary key, name text, age integer)')
+        for i in range(1, 10):
+            self.db.insert(User(id=i, name='u%d' % i, age=i % 2))
+
+    def tearDown(self):
+        self.db.close()
+        self.dir.cleanup()
+
+    def test_route(self):
+        self.assertEqual([shard.find_count({}, table=User) for shard in self.db.shards], [3, 3, 3])
+        self.assertEqual(self.db.shards[1].find_one(User, {'id': 4}).name, 'u4')
+        self.assertEqual(self.db.find_one(User, {'id': 4}).name, 'u4')
+        self.assertEqual(self.db.update(User(id=4, name='x', age=1)), 1)
+        self.assertEqual(self.db.find_one(User, {'name': 'x'}).id, 4)
+        with self.assertRaises(Exception):
+            self.db.insert({'name': 'no key'}, table='test_user')
+
+    def test_scatter_gather(self):
+        self.assertEqual(self.db.find_count({'age': 1}, table=User), 5)
+        users = self.db.find(User, {'age': 1}, order_by='-id')
+        self.assertEqual([user.id for user in users], [9, 7, 5, 3, 1])
+        rows = self.db.find('test_user', order_by=('age', 'id'))
+        self.assertEqual([row['id'] for row in rows], [2, 4, 6, 8, 1, 3, 5, 7, 9])
+        users = self.db.find(User, {'id__gt': 1}, order_by='id', limit=3, offset=2)
+        self.assertEqual([user.id for user in users], [4, 5, 6])
+        rows = self.db.find('test_user', {'age': 0}, dict, ('id', 'name'), '-id', 2)
+        self.assertEqual(rows, [{'id': 8, 'name': 'u8'}, {'id': 6, 'name': 'u6'}])
+        self.assertEqual(self.db.find_one(User, {'age': 1}, order_by='-id').id, 9)
+        self.assertEqual(self.db.find_one('test_user', {'age': 0}, dict, ('id', 'age'), 'id'), {'id': 2, 'age': 0})
+        self.assertEqual(self.db.delete(User, {'age': 0}), 4)
+        self.assertEqual(self.db.find_count({}, table=User), 5)
+
+    def test_close(self):
+        self.db.find_count({}, table=User)
+        self.assertEqual([len(shard._datasource._idle_cache) for shard in self.db.shards], [1, 1, 1])
+        self.db.close()
+        self.assertTrue(self.db._executor._shutdown)
+        self.assertEqual([len(shard._datasource._idle_cache) for shard in self.db.shards], [0, 0, 0])
+
+
+@dataclasses.dataclass
+class DataUser:
+    id: int
+    name: str
+    age: int
+
+
+class SlotsUser:
+    __slots__ = ('id', 'name', 'age')
+
+
+TupleUser = collections.namedtuple('TupleUser', ['id', 'name', 'age'])
+
+
+class RenamedUser:
+    TABLE_NAME = 'test_user'
+    COLUMN_MAP = {'name': 'username'}
+
+    def __init__(self, **kwargs):
+        self.username = kwargs.get('username')
+        self.age = kwargs.get('age')